@@ -5,16 +5,105 @@ import datetime
 import os,sys
 import json
 import tempfile
+import threading
+import sqlite3
+import math
+import queue
+import hashlib
+import heapq
+import itertools
+import random
+import atexit
+import http.server
+import shutil
+import fcntl
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
 from copy import deepcopy
 from uuid import uuid4
-from sentinelsat import SentinelAPI
-from time import sleep
+from sentinelsat import SentinelAPI, UnauthorizedError, InvalidChecksumError, LTATriggered
+from sentinelsat import SentinelAPIError, ServerError
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
+from time import sleep, perf_counter
+try:
+    # optional (2.0 or newer), without it the wkt of the scenes is sent to the hubs as is
+    import shapely
+    from shapely import get_parts
+except ImportError:
+    shapely = None
 
 
 now = datetime.datetime.utcnow()
 today = datetime.datetime(now.year,now.month,now.day)
-# keep this reasonable not to overload but not to miss
-nrt_polling_time = datetime.timedelta(seconds=60)
+# scenes are started when due, with random delay up to this many seconds so that scenes of a hub do not fire together
+schedule_jitter = 10
+# a hub giving login or query errors is not used for this long, doubled for every further error
+hub_backoff_time = datetime.timedelta(seconds=60)
+hub_backoff_max = datetime.timedelta(hours=1)
+# sessions and shared queries are cleaned up at least this often
+housekeeping_time = datetime.timedelta(seconds=60)
+# the config file is checked for changes this often
+config_check_time = datetime.timedelta(seconds=10)
+# scenes are run in parallel in a pool of this many workers
+scene_workers = 4
+# how many scenes may use the same hub at the same time (can be set per hub in the config)
+hub_concurrency = 2
+hub_limits = {}
+# hub sessions are reused across scenes and rounds, renewed after max age and closed when idle
+session_max_age = datetime.timedelta(hours=8)
+session_idle_time = datetime.timedelta(minutes=30)
+# index of downloaded products kept in each target directory
+index_filename = ".sentsync-index.sqlite"
+# reruns query only products ingested after the latest seen ingestion (minus overlap), with a full query every now and then
+watermark_overlap = 900
+full_query_interval = 3600
+# identical queries of different scenes within this time are sent to the hub only once
+query_share_time = datetime.timedelta(seconds=60)
+# the hubs get a simplified covering of the scene area with at most this many vertices per polygon, the products are filtered against the exact area
+query_vertices = 20
+# areas of several polygons are queried per polygon in parallel, up to this many (more are queried as their convex hull)
+max_query_parts = 8
+query_part_workers = 4
+# the queries of all date extents of the running scenes are sent at once by a pool of this many workers
+query_workers = 8
+# at most this many queries per second to the same hub (can be set per hub in the config), None for no limit
+hub_query_rate = 2
+hub_query_rates = {}
+# server errors and timeouts of a query are retried, after 2, 4, ... seconds
+query_timeout = 60
+query_retries = 2
+query_retry_delay = 2
+# long day ranges are queried in chunks of days, page by page, into a bounded download queue
+chunk_days = 30
+# a date extent is marked complete only if it ended that many days ago, hubs keep adding products for a while
+settle_days = 7
+download_queue_size = 20
+download_workers = 2
+# products failing this many times in a row are skipped for a while
+max_product_failures = 3
+product_failure_cooldown = datetime.timedelta(hours=24)
+download_chunk_size = 1024*1024
+# products downloaded once into a store shared by the scenes and linked into their target directories, off by default
+product_store = None
+store_link_methods = ["hardlink","reflink","copy"]
+store_filename = ".sentsync-store.sqlite"
+# products of the store not linked into any target directory are removed after this long
+store_prune_time = datetime.timedelta(hours=1)
+# download bandwidth in MB/s shared by all scenes and per hub (can be set per hub in the config), None for no limit
+bandwidth = None
+hub_bandwidth = None
+hub_bandwidth_limits = {}
+# downloads of lower priority scenes are slowed down to this many MB/s (0 pauses them) while higher priority products wait or download
+low_priority_bandwidth = 0
+# "text" or "json" (one json object per line)
+log_format = "text"
+# log files are kept open and reopened after this long, so that rotated files are followed
+log_reopen_time = datetime.timedelta(seconds=60)
+log_batch_size = 500
+# metrics in prometheus text format, served over http and/or rewritten to a file, both off by default
+metrics_port = None
+metrics_address = "127.0.0.1"
+metrics_file = None
 
 def getScriptPath():
     return os.path.dirname(os.path.realpath(sys.argv[0]))
@@ -22,16 +111,178 @@ def getScriptPath():
 def getScriptName():
     return os.path.splitext(os.path.realpath(sys.argv[0]))[0]
 
-def write2log(fpath,severity="INFO", description=""):
-    with open(fpath,'a') as fp:
-        ts = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S UTC')
-        fp.write("["+ts+"]")
-        fp.write(" ["+severity+"]")
-        fp.write(" ["+description+"]")
-        fp.write('\n')
+# log lines are written by a background thread, the callers only queue them
+log_queue = queue.Queue()
+
+def write2log(fpath,severity="INFO", description="", **fields):
+    # fields (scene, product, extent, seconds...) are written only in the json format
+    log_queue.put((fpath, datetime.datetime.utcnow(), severity, description, fields))
     # Debug
     # print(description)
 
+def format_log_line(ts, severity, description, fields):
+    if log_format == "json":
+        record = {"time": ts.strftime('%Y-%m-%dT%H:%M:%S.%fZ'), "severity": severity, "description": description}
+        record.update(fields)
+        return json.dumps(record, default=str)
+    return "[" + ts.strftime('%Y-%m-%dT%H:%M:%S UTC') + "] [" + severity + "] [" + description + "]"
+
+def log_writer():
+    # writes the queued lines in batches, a batch is flushed once the queue is empty
+    handles = {}
+    while True:
+        batch = [log_queue.get()]
+        try:
+            while len(batch) < log_batch_size:
+                batch.append(log_queue.get_nowait())
+        except queue.Empty:
+            pass
+        now = datetime.datetime.utcnow()
+        for line in batch:
+            if line is None:
+                for fp, opened in handles.values():
+                    fp.close()
+                return
+            fpath, ts, severity, description, fields = line
+            try:
+                if fpath not in handles:
+                    handles[fpath] = (open(fpath,'a'), now)
+                handles[fpath][0].write(format_log_line(ts, severity, description, fields) + '\n')
+            except Exception:
+                pass
+        for fpath in list(handles):
+            fp, opened = handles[fpath]
+            try:
+                fp.flush()
+            except Exception:
+                pass
+            if now - opened > log_reopen_time:
+                fp.close()
+                del handles[fpath]
+
+def close_log():
+    log_queue.put(None)
+    log_thread.join()
+
+log_thread = threading.Thread(target=log_writer, daemon=True)
+log_thread.start()
+atexit.register(close_log)
+
+metrics_lock = threading.Lock()
+metrics = {}
+seconds_buckets = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800]
+speed_buckets = [0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500]
+metric_types = {
+    "sentsync_logins_total": ("counter", "Hub sessions created."),
+    "sentsync_query_seconds": ("histogram", "Latency of the hub queries."),
+    "sentsync_query_products_total": ("counter", "Products returned by the hub queries."),
+    "sentsync_query_errors_total": ("counter", "Scene runs stopped by login or query errors."),
+    "sentsync_products_existing_total": ("counter", "Products found but skipped as already downloaded."),
+    "sentsync_downloaded_products_total": ("counter", "Products downloaded."),
+    "sentsync_downloaded_bytes_total": ("counter", "Bytes downloaded."),
+    "sentsync_download_seconds": ("histogram", "Download time of a product."),
+    "sentsync_download_speed_mb_per_second": ("histogram", "Download speed of a product in MB/s."),
+    "sentsync_checksum_seconds": ("histogram", "Time spent computing the checksum of a product."),
+    "sentsync_download_errors_total": ("counter", "Failed download attempts."),
+    "sentsync_products_failed_total": ("counter", "Products skipped after failed download attempts."),
+    "sentsync_lta_retrievals_total": ("counter", "Offline products requested from the long term archive."),
+    "sentsync_download_queue_depth": ("gauge", "Products waiting in the download queue of the scene."),
+    "sentsync_cleanup_deleted_total": ("counter", "Products removed by the rolling sync."),
+    "sentsync_scene_runs_total": ("counter", "Completed scene runs."),
+    "sentsync_scene_run_seconds": ("histogram", "Duration of the scene runs."),
+    "sentsync_scene_start_delay_seconds": ("histogram", "Time from the due time of a scene to its start."),
+    "sentsync_last_success_timestamp_seconds": ("gauge", "Unix time of the last successful run of the scene."),
+    "sentsync_seconds_since_last_success": ("gauge", "Seconds since the last successful run of the scene."),
+    "sentsync_rerun_latency_seconds": ("gauge", "Configured rerun-latency of the scene."),
+    "sentsync_scenes_running": ("gauge", "Scenes running."),
+    "sentsync_scenes_waiting": ("gauge", "Due scenes waiting for a worker or a hub."),
+    "sentsync_hub_errors_in_row": ("gauge", "Consecutive login or query errors of the hub."),
+    "sentsync_log_queue_depth": ("gauge", "Log lines waiting to be written."),
+    "sentsync_bandwidth_wait_seconds_total": ("counter", "Time downloads waited for the bandwidth limits or for higher priority downloads."),
+    "sentsync_pending_downloads": ("gauge", "Products waiting for download or downloading, per priority."),
+    "sentsync_query_retries_total": ("counter", "Queries retried after server errors or timeouts."),
+    "sentsync_store_links_total": ("counter", "Products linked from the product store into a target directory."),
+    "sentsync_store_waits_total": ("counter", "Products waited for as another scene was downloading them."),
+    "sentsync_store_pruned_total": ("counter", "Products removed from the product store as no target directory had them anymore."),
+}
+
+def count_metric(name, value=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with metrics_lock:
+        metrics[key] = metrics.get(key, 0) + value
+
+def set_metric(name, value, **labels):
+    with metrics_lock:
+        metrics[(name, tuple(sorted(labels.items())))] = value
+
+def observe_metric(name, value, buckets=seconds_buckets, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with metrics_lock:
+        if key not in metrics:
+            metrics[key] = {"buckets": buckets, "counts": [0] * len(buckets), "sum": 0, "count": 0}
+        # bucket counts are cumulative
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                metrics[key]["counts"][i] += 1
+        metrics[key]["sum"] += value
+        metrics[key]["count"] += 1
+
+def format_metric_labels(labels):
+    if len(labels) == 0:
+        return ""
+    return "{" + ",".join('%s="%s"' % (label, str(value).replace("\\","\\\\").replace('"','\\"').replace("\n","\\n")) for label, value in labels) + "}"
+
+def format_metrics():
+    # prometheus text format
+    now = datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc).timestamp()
+    set_metric("sentsync_log_queue_depth", log_queue.qsize())
+    lines = []
+    with metrics_lock:
+        for (name, labels), value in list(metrics.items()):
+            if name == "sentsync_last_success_timestamp_seconds":
+                metrics[("sentsync_seconds_since_last_success", labels)] = now - value
+        for name, (metric_type, description) in metric_types.items():
+            lines.append("# HELP %s %s" % (name, description))
+            lines.append("# TYPE %s %s" % (name, metric_type))
+            for (metric_name, labels), value in sorted(metrics.items(), key=lambda item: item[0]):
+                if metric_name != name:
+                    continue
+                if metric_type == "histogram":
+                    for bound, count in zip(value["buckets"], value["counts"]):
+                        lines.append("%s_bucket%s %s" % (name, format_metric_labels(labels + (("le", bound),)), count))
+                    lines.append("%s_bucket%s %s" % (name, format_metric_labels(labels + (("le", "+Inf"),)), value["count"]))
+                    lines.append("%s_sum%s %s" % (name, format_metric_labels(labels), value["sum"]))
+                    lines.append("%s_count%s %s" % (name, format_metric_labels(labels), value["count"]))
+                else:
+                    lines.append("%s%s %s" % (name, format_metric_labels(labels), value))
+    return "\n".join(lines) + "\n"
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ["/", "/metrics"]:
+            self.send_error(404)
+            return
+        body = format_metrics().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server():
+    server = http.server.ThreadingHTTPServer((metrics_address, metrics_port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+def write_metrics_file():
+    # replaced in one go, readers never see a partial file
+    with open(metrics_file + ".tmp", "w") as f:
+        f.write(format_metrics())
+    os.replace(metrics_file + ".tmp", metrics_file)
+
 basedir = getScriptPath()
 tmpdir = tempfile.gettempdir()
 parent_log_path = os.path.join(basedir,getScriptName() + '.log')
@@ -64,226 +315,300 @@ parser.add_argument('--password', help = "Password for the Sentinel hub.")
 parser.add_argument('--credentials-file', help = "Credentils file for the Sentinel hub. Do not use url, username and password with this. See readme for format.")
 
 parser.add_argument('--rerun-latency', help = "Rerun the download if that many seconds has passed. (NRT option)")
+parser.add_argument('--watermark-overlap', help = "On reruns, query products ingested at most that many seconds before the latest already seen ingestion (default %s). (NRT option)" % watermark_overlap)
+parser.add_argument('--query-vertices', help = "Query the hub with a simplified area covering the given one, of at most that many vertices per polygon; the products are then filtered against the given area (default %s, 0 to not simplify). Needs shapely." % query_vertices)
+parser.add_argument('--chunk-days', help = "Query a day range in chunks of that many days (default %s)." % chunk_days)
+parser.add_argument('--settle-days', help = "A date extent with all products downloaded is not queried again if it ended that many days ago (default %s)." % settle_days)
+parser.add_argument('--priority', help = "Priority of the scene (int), 0 is the highest. Scenes with lower values are started and download first (default 0 with day-offset, 1 otherwise).")
+parser.add_argument('--full-query-interval', help = "On reruns, query the whole date extents again if that many seconds has passed (default %s). (NRT option)" % full_query_interval)
+
+parser.add_argument('--rebuild-index', action = "store_const", const = True, help = "Rescan the target directories and rebuild their product indexes at start. Can be used with config-file.")
+parser.add_argument('--plan', action = "store_const", const = True, help = "Print the queries the scenes would send to the hubs and their estimated cost, then exit. Can be used with config-file.")
+parser.add_argument('--invalidate', action = "append", metavar = "SCENE", help = "Forget the completed date extents of the scene (name in the config file, \"all\" for all scenes) so that they are queried again. Can be used multiple times and with config-file.")
 
 args = parser.parse_args()
-arg_list = [arg.replace('_','-') for arg in list(args.__dict__.keys())]
-value_list = list(args.__dict__.values())
+# options of the script itself, not of the scenes
+script_args = ["rebuild-index","plan","invalidate"]
+arg_list = [arg.replace('_','-') for arg in list(args.__dict__.keys()) if arg.replace('_','-') not in script_args]
+value_list = [args.__dict__[arg.replace('-','_')] for arg in arg_list]
 
-if args.config_file is not None:
-    args.config_file = os.path.realpath(args.config_file)
-    # Check if other arguments supplied
-    if value_list.count(None) != len(value_list)-1:
-        write2log(parent_log_path,"ERROR","Cannot use other arguments with config-file.")
-        write2log(parent_log_path,"INFO",'Terminating. Use --help for usage.')
-        exit()
+class ConfigError(Exception):
+    # invalid config file or arguments, scene_label is None for problems outside the scenes
+    def __init__(self, message, scene_label=None):
+        Exception.__init__(self, message)
+        self.scene_label = scene_label
 
-    # Check and parse config file
-    cfg_path = args.config_file
+def load_config(config_file):
     try:
-        cfg = json.load(open(cfg_path,'r'))
+        with open(config_file,'r') as f:
+            return json.load(f)
     except Exception:
-        write2log(parent_log_path,"ERROR","Problem in config file JSON format, check config file.")
-        write2log(parent_log_path,"ERROR",'Terminating')
-        exit()
+        raise ConfigError("Problem in config file JSON format, check config file.")
 
+# defaults of the daemon options, an option removed from a reloaded config goes back to its default
+daemon_defaults = {
+    "scene_workers": scene_workers, "hub_concurrency": hub_concurrency, "hub_limits": hub_limits,
+    "download_queue_size": download_queue_size, "download_workers": download_workers,
+    "max_product_failures": max_product_failures, "product_failure_cooldown": product_failure_cooldown,
+    "schedule_jitter": schedule_jitter, "hub_backoff_time": hub_backoff_time, "hub_backoff_max": hub_backoff_max,
+    "query_workers": query_workers, "hub_query_rate": hub_query_rate, "hub_query_rates": hub_query_rates,
+    "query_timeout": query_timeout, "query_retries": query_retries,
+    "product_store": product_store, "store_link_methods": store_link_methods,
+    "bandwidth": bandwidth, "hub_bandwidth": hub_bandwidth, "hub_bandwidth_limits": hub_bandwidth_limits, "low_priority_bandwidth": low_priority_bandwidth,
+    "log_format": log_format, "metrics_port": metrics_port, "metrics_address": metrics_address, "metrics_file": metrics_file,
+    "session_max_age": session_max_age, "session_idle_time": session_idle_time,
+}
+
+def parse_hub_option(value, default, convert, valid):
+    # a number for all hubs or an object of hub-url: number, "*" being the default for the other hubs;
+    # returns (default, {hub-url: number}), raises ValueError if a number given is not valid
+    if not isinstance(value, dict):
+        value = {"*": value}
+    if len(value) == 0:
+        raise ValueError
+    limits = {hub_url: convert(limit) for hub_url, limit in value.items()}
+    if not all(valid(limit) for limit in limits.values()):
+        raise ValueError
+    default = limits.pop("*", default)
+    return default, limits
+
+def parse_daemon_options(cfg):
+    # daemon wide options, all optional, returned as {variable name: value}
+    options = deepcopy(daemon_defaults)
+    if "daemon" not in cfg:
+        return options
+    try:
+        if "scene-workers" in cfg["daemon"]:
+            options["scene_workers"] = int(cfg["daemon"]["scene-workers"])
+            if options["scene_workers"] < 1:
+                raise ValueError
+        if "hub-concurrency" in cfg["daemon"]:
+            options["hub_concurrency"], options["hub_limits"] = parse_hub_option(cfg["daemon"]["hub-concurrency"], options["hub_concurrency"], int, lambda limit: limit >= 1)
+        if "download-queue-size" in cfg["daemon"]:
+            options["download_queue_size"] = int(cfg["daemon"]["download-queue-size"])
+            if options["download_queue_size"] < 1:
+                raise ValueError
+        if "download-workers" in cfg["daemon"]:
+            options["download_workers"] = int(cfg["daemon"]["download-workers"])
+            if options["download_workers"] < 1:
+                raise ValueError
+        if "max-product-failures" in cfg["daemon"]:
+            options["max_product_failures"] = int(cfg["daemon"]["max-product-failures"])
+        if "product-failure-cooldown" in cfg["daemon"]:
+            options["product_failure_cooldown"] = datetime.timedelta(seconds=int(cfg["daemon"]["product-failure-cooldown"]))
+        if "schedule-jitter" in cfg["daemon"]:
+            options["schedule_jitter"] = float(cfg["daemon"]["schedule-jitter"])
+        if "hub-backoff" in cfg["daemon"]:
+            options["hub_backoff_time"] = datetime.timedelta(seconds=int(cfg["daemon"]["hub-backoff"]))
+        if "hub-backoff-max" in cfg["daemon"]:
+            options["hub_backoff_max"] = datetime.timedelta(seconds=int(cfg["daemon"]["hub-backoff-max"]))
+        if "query-workers" in cfg["daemon"]:
+            options["query_workers"] = int(cfg["daemon"]["query-workers"])
+            if options["query_workers"] < 1:
+                raise ValueError
+        if "hub-query-rate" in cfg["daemon"]:
+            # null for no limit
+            options["hub_query_rate"], options["hub_query_rates"] = parse_hub_option(cfg["daemon"]["hub-query-rate"], options["hub_query_rate"],
+                lambda limit: None if limit is None else float(limit), lambda limit: limit is None or limit > 0)
+        if "query-timeout" in cfg["daemon"]:
+            options["query_timeout"] = float(cfg["daemon"]["query-timeout"])
+            if options["query_timeout"] <= 0:
+                raise ValueError
+        if "query-retries" in cfg["daemon"]:
+            options["query_retries"] = int(cfg["daemon"]["query-retries"])
+            if options["query_retries"] < 0:
+                raise ValueError
+        if "product-store" in cfg["daemon"]:
+            options["product_store"] = os.path.realpath(str(cfg["daemon"]["product-store"]))
+            os.makedirs(options["product_store"], exist_ok=True)
+            if not os.access(options["product_store"], os.W_OK):
+                raise ValueError
+        if "product-store-link" in cfg["daemon"]:
+            methods = cfg["daemon"]["product-store-link"]
+            options["store_link_methods"] = [methods] if isinstance(methods,str) else list(methods)
+            if len(options["store_link_methods"]) == 0 or not set(options["store_link_methods"]) <= set(store_link_methods):
+                raise ValueError
+        if "bandwidth" in cfg["daemon"]:
+            options["bandwidth"] = float(cfg["daemon"]["bandwidth"])
+            if options["bandwidth"] <= 0:
+                raise ValueError
+        if "hub-bandwidth" in cfg["daemon"]:
+            options["hub_bandwidth"], options["hub_bandwidth_limits"] = parse_hub_option(cfg["daemon"]["hub-bandwidth"], options["hub_bandwidth"], float, lambda limit: limit > 0)
+        if "low-priority-bandwidth" in cfg["daemon"]:
+            options["low_priority_bandwidth"] = float(cfg["daemon"]["low-priority-bandwidth"])
+            if options["low_priority_bandwidth"] < 0:
+                raise ValueError
+        if "log-format" in cfg["daemon"]:
+            if cfg["daemon"]["log-format"] not in ["text","json"]:
+                raise ValueError
+            options["log_format"] = cfg["daemon"]["log-format"]
+        if "metrics-port" in cfg["daemon"]:
+            options["metrics_port"] = int(cfg["daemon"]["metrics-port"])
+        if "metrics-address" in cfg["daemon"]:
+            options["metrics_address"] = str(cfg["daemon"]["metrics-address"])
+        if "metrics-file" in cfg["daemon"]:
+            options["metrics_file"] = str(cfg["daemon"]["metrics-file"])
+        if "session-max-age" in cfg["daemon"]:
+            options["session_max_age"] = datetime.timedelta(seconds=int(cfg["daemon"]["session-max-age"]))
+        if "session-idle-time" in cfg["daemon"]:
+            options["session_idle_time"] = datetime.timedelta(seconds=int(cfg["daemon"]["session-idle-time"]))
+    except Exception:
+        raise ConfigError("Problem in daemon options of the config file, check config file.")
+    return options
+
+def apply_daemon_options(options):
+    # the options are module variables read where they are used
+    globals().update(options)
+
+def read_scenes(cfg, config_file):
     # read scenes and merge with shared options, fill missing as None
     scenes = {}
-    for scene_label in cfg["scenes"]:
-        for product in cfg["scenes"][scene_label]["products"]:
-            scene_label_product = scene_label+"|"+product
-            scenes.update(
-                deepcopy(
-                    {scene_label_product: cfg["scenes"][scene_label]}
+    try:
+        for scene_label in cfg["scenes"]:
+            for product in cfg["scenes"][scene_label]["products"]:
+                scene_label_product = scene_label+"|"+product
+                scenes.update(
+                    deepcopy(
+                        {scene_label_product: cfg["scenes"][scene_label]}
+                    )
                 )
-            )
-            scenes[scene_label_product].pop("products")
-            scenes[scene_label_product].update(
-                deepcopy(cfg["scenes"][scene_label]["products"][product])
-            )
-            scenes[scene_label_product].update({"config-file":args.config_file})
-            scenes[scene_label_product].update({"product":product})
-            for arg in arg_list:
-                if arg not in scenes[scene_label_product]:
-                    if arg in cfg["shared"]:
-                        scenes[scene_label_product].update({arg:deepcopy(cfg["shared"][arg])})
-                    else:
-                        scenes[scene_label_product].update({arg:None})
-
-            scenes[scene_label_product].update({"last-run-time":None})
+                scenes[scene_label_product].pop("products")
+                scenes[scene_label_product].update(
+                    deepcopy(cfg["scenes"][scene_label]["products"][product])
+                )
+                scenes[scene_label_product].update({"config-file":config_file})
+                scenes[scene_label_product].update({"product":product})
+                for arg in arg_list:
+                    if arg not in scenes[scene_label_product]:
+                        if "shared" in cfg and arg in cfg["shared"]:
+                            scenes[scene_label_product].update({arg:deepcopy(cfg["shared"][arg])})
+                        else:
+                            scenes[scene_label_product].update({arg:None})
 
-else:
-    # set cli options as scene
-    scenes = {
-        "cli" : {
-            "last-run-time" : None
-        }
-    }
-    for a,arg in enumerate(arg_list):
-        scenes["cli"].update({arg:value_list[a]})
+                scenes[scene_label_product].update({"last-run-time":None, "last-full-query":None, "watermarks":{}})
+    except Exception:
+        raise ConfigError("Problem in scenes of the config file, check config file.")
+    return scenes
 
-# parse, complete, check options
-for scene_label in scenes:
+def check_scene(scene_label, scene):
+    # parse, complete, check options of a scene in place
     # Check required and combinations
-    if (scenes[scene_label]["day"], scenes[scene_label]["day-offset"], scenes[scene_label]["day-range"]).count(None) != 2:
-        write2log(parent_log_path,"ERROR","Use minimum and only one of the temporal arguments.")
-        if scene_label == "cli":
-            terminate_cli()
-        else:
-            terminate_cfg(scenes[scene_label]["config-file"],scene_label)
+    if (scene["day"], scene["day-offset"], scene["day-range"]).count(None) != 2:
+        raise ConfigError("Use minimum and only one of the temporal arguments.", scene_label)
     # TODO add other type of extent (what?)
-    if scenes[scene_label]["wkt"] is None:
-        write2log(parent_log_path,"ERROR","Spatial extent is required.")
-        if scene_label == "cli":
-            terminate_cli()
-        else:
-            terminate_cfg(scenes[scene_label]["config-file"],scene_label)
-    if scenes[scene_label]["product"] is None:
-        write2log(parent_log_path,"ERROR","Product type is required.")
-        if scene_label == "cli":
-            terminate_cli()
-        else:
-            terminate_cfg(scenes[scene_label]["config-file"],scene_label)
-    if scenes[scene_label]["target-dir"] is None:
-        write2log(parent_log_path,"ERROR","Target directory is required.")
-        if scene_label == "cli":
-            terminate_cli()
-        else:
-            terminate_cfg(scenes[scene_label]["config-file"],scene_label)
-    if scenes[scene_label]["log-file"] is None:
-        write2log(parent_log_path,"ERROR","Path to log file is required.")
-        if scene_label == "cli":
-            terminate_cli()
-        else:
-            terminate_cfg(scenes[scene_label]["config-file"],scene_label)
-    if scenes[scene_label]["credentials-file"] is None and (scenes[scene_label]["hub-url"], scenes[scene_label]["username"], scenes[scene_label]["password"]).count(None) != 0:
-        write2log(parent_log_path,"ERROR","Arguments for credentials are missing.")
-        if scene_label == "cli":
-            terminate_cli()
-        else:
-            terminate_cfg(scenes[scene_label]["config-file"],scene_label)
-    if scenes[scene_label]["credentials-file"] is not None and (scenes[scene_label]["hub-url"], scenes[scene_label]["username"], scenes[scene_label]["password"]).count(None) != 3:
-        write2log(parent_log_path,"ERROR","Credential files and other credentials arguments cannot be used together.")
-        if scene_label == "cli":
-            terminate_cli()
-        else:
-            terminate_cfg(scenes[scene_label]["config-file"],scene_label)
+    if scene["wkt"] is None:
+        raise ConfigError("Spatial extent is required.", scene_label)
+    if scene["product"] is None:
+        raise ConfigError("Product type is required.", scene_label)
+    if scene["target-dir"] is None:
+        raise ConfigError("Target directory is required.", scene_label)
+    if scene["log-file"] is None:
+        raise ConfigError("Path to log file is required.", scene_label)
+    if scene["credentials-file"] is None and (scene["hub-url"], scene["username"], scene["password"]).count(None) != 0:
+        raise ConfigError("Arguments for credentials are missing.", scene_label)
+    if scene["credentials-file"] is not None and (scene["hub-url"], scene["username"], scene["password"]).count(None) != 3:
+        raise ConfigError("Credential files and other credentials arguments cannot be used together.", scene_label)
 
     # Is rerun latency integer?
-    if scenes[scene_label]["rerun-latency"] is not None:
+    if scene["rerun-latency"] is not None:
         try:
-            scenes[scene_label]["rerun-latency"] = int(scenes[scene_label]["rerun-latency"])
+            scene["rerun-latency"] = int(scene["rerun-latency"])
         except:
-            write2log(parent_log_path,"ERROR","Rerun latency is not an integer.")
-            if scene_label == "cli":
-                terminate_cli()
-            else:
-                terminate_cfg(scenes[scene_label]["config-file"],scene_label)
+            raise ConfigError("Rerun latency is not an integer.", scene_label)
+
+    for arg, default in [("watermark-overlap",watermark_overlap),("full-query-interval",full_query_interval),("chunk-days",chunk_days),("settle-days",settle_days),("query-vertices",query_vertices)]:
+        if scene[arg] is None:
+            scene[arg] = default
+        try:
+            scene[arg] = int(scene[arg])
+            if arg == "chunk-days" and scene[arg] < 1:
+                raise ValueError
+            if arg == "query-vertices" and scene[arg] != 0 and scene[arg] < 4:
+                raise ValueError
+        except:
+            raise ConfigError("%s is not an integer." % arg.capitalize().replace("-"," "), scene_label)
+
+    if scene["priority"] is None:
+        # NRT scenes go ahead of backfill work
+        scene["priority"] = 0 if scene["day-offset"] is not None else 1
+    try:
+        scene["priority"] = int(scene["priority"])
+    except:
+        raise ConfigError("Priority is not an integer.", scene_label)
 
     # use realpaths
-    for arg in scenes[scene_label]:
+    for arg in scene:
         if arg in ["target-dir","log-file","credentials-file"]:
-            if scenes[scene_label][arg] is not None:
-                scenes[scene_label][arg] = os.path.realpath(scenes[scene_label][arg])
+            if scene[arg] is not None:
+                scene[arg] = os.path.realpath(scene[arg])
 
     # check existence-permissions
-    if os.path.exists(scenes[scene_label]["log-file"]):
+    if os.path.exists(scene["log-file"]):
         write2log(parent_log_path,"INFO","Log file in the config exists. Log will be appended.")
-        if not os.access(scenes[scene_label]["log-file"], os.W_OK):
-            write2log(parent_log_path,"ERROR","Log file in config is not writable.")
-            if scene_label == "cli":
-                terminate_cli()
-            else:
-                terminate_cfg(scenes[scene_label]["config-file"],scene_label)
+        if not os.access(scene["log-file"], os.W_OK):
+            raise ConfigError("Log file in config is not writable.", scene_label)
     else:
         try:
-            os.makedirs(os.path.split(scenes[scene_label]["log-file"])[0],exist_ok = True)
+            os.makedirs(os.path.split(scene["log-file"])[0],exist_ok = True)
         except:
-            write2log(parent_log_path,"ERROR","Log file in config is not writable.")
-            if scene_label == "cli":
-                terminate_cli()
-            else:
-                terminate_cfg(scenes[scene_label]["config-file"],scene_label)
-    if os.path.exists(scenes[scene_label]["target-dir"]):
+            raise ConfigError("Log file in config is not writable.", scene_label)
+    if os.path.exists(scene["target-dir"]):
         write2log(parent_log_path,"INFO","Target directory in the config exists.")
-        if not os.access(scenes[scene_label]["target-dir"], os.W_OK):
-            write2log(parent_log_path,"ERROR","Target directory in config is not writable.")
-            if scene_label == "cli":
-                terminate_cli()
-            else:
-                terminate_cfg(scenes[scene_label]["config-file"],scene_label)
+        if not os.access(scene["target-dir"], os.W_OK):
+            raise ConfigError("Target directory in config is not writable.", scene_label)
     else:
         try:
-            os.makedirs(scenes[scene_label]["target-dir"],exist_ok = True)
+            os.makedirs(scene["target-dir"],exist_ok = True)
         except:
-            write2log(parent_log_path,"ERROR","Log file in config is not writable.")
-            if scene_label == "cli":
-                terminate_cli()
-            else:
-                terminate_cfg(scenes[scene_label]["config-file"],scene_label)
-        
+            raise ConfigError("Log file in config is not writable.", scene_label)
+
     # temporals
-    if scenes[scene_label]["day-range"] is not None:
+    if scene["day-range"] is not None:
         try:
-            scenes[scene_label]["day-range"] = scenes[scene_label]["day-range"].split("-")
-            scenes[scene_label]["day-range"][0] = datetime.datetime.strptime(scenes[scene_label]["day-range"][0],"%Y%m%d")
-            scenes[scene_label]["day-range"][1] = datetime.datetime.strptime(scenes[scene_label]["day-range"][1],"%Y%m%d")
-            scenes[scene_label]["day-range"] = tuple(scenes[scene_label]["day-range"])
-            if len(scenes[scene_label]["day-range"]) != 2:
+            scene["day-range"] = scene["day-range"].split("-")
+            scene["day-range"][0] = datetime.datetime.strptime(scene["day-range"][0],"%Y%m%d")
+            scene["day-range"][1] = datetime.datetime.strptime(scene["day-range"][1],"%Y%m%d")
+            scene["day-range"] = tuple(scene["day-range"])
+            if len(scene["day-range"]) != 2:
                 raise
         except:
-            write2log(parent_log_path,"ERROR","Day string %s not in correct format." % scenes[scene_label]["day-range"])
-            if scene_label == "cli":
-                terminate_cli()
-            else:
-                terminate_cfg(scenes[scene_label]["config-file"],scene_label)
+            raise ConfigError("Day string %s not in correct format." % scene["day-range"], scene_label)
 
-    if scenes[scene_label]["day"] is not None:
+    if scene["day"] is not None:
         daylist = []
-        if isinstance(scenes[scene_label]["day"],str):
-            scenes[scene_label]["day"] = [scenes[scene_label]["day"]]
-        for day in scenes[scene_label]["day"]:
+        if isinstance(scene["day"],str):
+            scene["day"] = [scene["day"]]
+        for day in scene["day"]:
             try:
                 day = datetime.datetime.strptime(day,"%Y%m%d")
             except:
-                write2log(parent_log_path,"ERROR","Day list or day string in day list %s not in correct format." % scenes[scene_label]["day"])
-                if scene_label == "cli":
-                    terminate_cli()
-                else:
-                    terminate_cfg(scenes[scene_label]["config-file"],scene_label)
+                raise ConfigError("Day list or day string in day list %s not in correct format." % scene["day"], scene_label)
             daylist.append(day)
-        scenes[scene_label]["day"] = deepcopy(daylist)
+        scene["day"] = deepcopy(daylist)
 
-    if scenes[scene_label]["day-offset"] is not None:
+    if scene["day-offset"] is not None:
         offsetlist = []
-        for day_offset in scenes[scene_label]["day-offset"]:
+        for day_offset in scene["day-offset"]:
             try:
                 if day_offset != int(day_offset):   # a number and integer
                     raise
                 day_offset = int(day_offset)
             except:
-                write2log(parent_log_path,severity="ERROR",description="Day offset %s in argument not in correct format." % day_offset)
-                if scene_label == "cli":
-                    terminate_cli()
-                else:
-                    terminate_cfg(scenes[scene_label]["config-file"],scene_label)
+                raise ConfigError("Day offset %s in argument not in correct format." % day_offset, scene_label)
             if day_offset > 0:
-                write2log(parent_log_path,severity="ERROR",description="Day offset %s means a future day. No foretelling." % day_offset)
-                if scene_label == "cli":
-                    terminate_cli()
-                else:
-                    terminate_cfg(scenes[scene_label]["config-file"],scene_label)
+                raise ConfigError("Day offset %s means a future day. No foretelling." % day_offset, scene_label)
             offsetlist.append(day_offset)
-        scenes[scene_label]["day-offset"] = deepcopy(offsetlist)
+        scene["day-offset"] = deepcopy(offsetlist)
 
     # TODO check extent (if poly or bb is valid)
-    if "+" in scenes[scene_label]["wkt"]:
+    if "+" in scene["wkt"]:
         write2log(parent_log_path,severity="WARNING",description=" + Sign found in WKT in scene %s. Replacing with spaces." % scene_label)
-        scenes[scene_label]["wkt"] = scenes[scene_label]["wkt"].replace("+"," ")
+        scene["wkt"] = scene["wkt"].replace("+"," ")
 
     # credentials
-    if scenes[scene_label]["credentials-file"] is not None:
+    if scene["credentials-file"] is not None:
         try:
-            with open(scenes[scene_label]["credentials-file"],"r") as f:
+            with open(scene["credentials-file"],"r") as f:
                 for line in f:
                     for arg in ["hub-url","username","password"]:
                         key = arg + ":"
@@ -291,131 +616,1519 @@ for scene_label in scenes:
                             line = line[len(key):]
                             if line[-1:] == "\n":
                                 line = line[:-1]
-                            scenes[scene_label][arg] = line
-            if [scenes[scene_label][arg] for arg in ["hub-url","username","password"]].count(None) != 0:
+                            scene[arg] = line
+            if [scene[arg] for arg in ["hub-url","username","password"]].count(None) != 0:
                 raise
         except:
-            write2log(parent_log_path,severity="ERROR",description="Credentials file in incorrect format or has missing fields. See readme.")
-            if scene_label == "cli":
-                terminate_cli()
-            else:
-                terminate_cfg(scenes[scene_label]["config-file"],scene_label)
+            raise ConfigError("Credentials file in incorrect format or has missing fields. See readme.", scene_label)
+
+def terminate_config(error):
+    write2log(parent_log_path,"ERROR",str(error))
+    if error.scene_label is None:
+        write2log(parent_log_path,"ERROR",'Terminating')
+        exit()
+    elif error.scene_label == "cli":
+        terminate_cli()
+    else:
+        terminate_cfg(args.config_file,error.scene_label)
+
+if args.config_file is not None:
+    args.config_file = os.path.realpath(args.config_file)
+    # Check if other arguments supplied
+    if value_list.count(None) != len(value_list)-1:
+        write2log(parent_log_path,"ERROR","Cannot use other arguments with config-file.")
+        write2log(parent_log_path,"INFO",'Terminating. Use --help for usage.')
+        exit()
+
+    # Check and parse config file
+    config_mtime = os.stat(args.config_file).st_mtime_ns if os.path.exists(args.config_file) else None
+    try:
+        cfg = load_config(args.config_file)
+        apply_daemon_options(parse_daemon_options(cfg))
+        scenes = read_scenes(cfg, args.config_file)
+    except ConfigError as e:
+        terminate_config(e)
+
+else:
+    # set cli options as scene
+    scenes = {
+        "cli" : {
+            "last-run-time" : None,
+            "last-full-query" : None,
+            "watermarks" : {}
+        }
+    }
+    for a,arg in enumerate(arg_list):
+        scenes["cli"].update({arg:value_list[a]})
+
+for scene_label in scenes:
+    try:
+        check_scene(scene_label, scenes[scene_label])
+    except ConfigError as e:
+        terminate_config(e)
 
 write2log(parent_log_path,severity="INFO",description="Config file and/or arguments are valid. Proceeding to download.")
 
 # check if there is any scene with rerun-latency option
-keep_running = False
-last_run_time = None
 for scene_label in scenes:
     if scenes[scene_label]["rerun-latency"] is not None:
-        keep_running = True
         write2log(parent_log_path,severity="INFO",description="At least one scene has rerun option, the script will be kept open for re-downloading.")
         break
 
-while last_run_time is None or keep_running:
-    # Re-run/NRT check/set for the script       
-    # if not the first run (also means some scene has rerun option) and the time has not passed yet, sleep that much (dont overload the machine)
-    if last_run_time is not None and datetime.datetime.utcnow() - last_run_time < nrt_polling_time:
-        nap_time = nrt_polling_time - (datetime.datetime.utcnow() - last_run_time)
-        write2log(parent_log_path,severity="INFO",description="At least one scene has rerun option, but NRT polling time for the script has not passed yet. Sleeping %s seconds." % nap_time.total_seconds())
-        sleep(nap_time.total_seconds())
-    last_run_time = datetime.datetime.utcnow()
-    last_run_day = datetime.datetime(last_run_time.year,last_run_time.month,last_run_time.day)
+sessions = {}
+# sessions replaced in the pool while scenes still use them, closed when the last one releases them
+retired_sessions = []
+# the downloads of a hub user, shared by its sessions
+download_semaphores = {}
+sessions_lock = threading.Lock()
 
-    for scene_label in scenes:
-        # Re-run/NRT check/set for the scene
-        # if not the first run and (scene has no rerun option or the time has not passed yet), skip this scene
-        if scenes[scene_label]["last-run-time"] is not None and (scenes[scene_label]["rerun-latency"] is None or datetime.datetime.utcnow() - scenes[scene_label]["last-run-time"] < datetime.timedelta(seconds=scenes[scene_label]["rerun-latency"])):
-            if scenes[scene_label]["rerun-latency"] is not None:
-                write2log(parent_log_path,severity="INFO",description="The scene %s has rerun option, but requested latency has not passed yet. Skipping the scene." % scene_label)
-            continue
-        scenes[scene_label]["last-run-time"] = datetime.datetime.utcnow()
-
-        date_extents = []
-        if scenes[scene_label]["day-range"] is not None:
-            date_extents = [list(scenes[scene_label]["day-range"])]
-            date_extents[0][1] += datetime.timedelta(days=1,seconds=-1)
-            date_extents[0] = tuple(date_extents[0])
-
-        if scenes[scene_label]["day"] is not None:
-            for day in scenes[scene_label]["day"]:
-                date_extents.append((day, day + datetime.timedelta(days=1,seconds=-1)))
-
-        if scenes[scene_label]["day-offset"] is not None:
-            for day_offset in scenes[scene_label]["day-offset"]:
-                day = last_run_day + datetime.timedelta(days=day_offset)
-                date_extents.append((day, day + datetime.timedelta(days=1,seconds=-1)))
-                
-        write2log(parent_log_path,severity="INFO",description="Processing download of %s products for the scene \"%s\". Scene options:" % (scenes[scene_label]["product"],scene_label.replace("|"+scenes[scene_label]["product"],"")))
-        write2log(parent_log_path,severity="INFO",description="- Area: %s" % scenes[scene_label]["wkt"])
-        for date_extent in date_extents:
-            write2log(parent_log_path,severity="INFO",description="- Date range: %s - %s" % (date_extent[0].strftime("%Y%m%dT%H%M%S"), date_extent[1].strftime("%Y%m%dT%H%M%S")))
-        write2log(parent_log_path,severity="INFO",description="- Hub: %s" % scenes[scene_label]["hub-url"])
-        write2log(parent_log_path,severity="INFO",description="- Target directory: %s" % scenes[scene_label]["target-dir"])
-        write2log(parent_log_path,severity="INFO",description="- Log file: %s" % scenes[scene_label]["log-file"])
+class TimeoutHTTPAdapter(HTTPAdapter):
+    # sentinelsat sends the queries without a timeout, a hanging query would block its scene
+    def send(self, request, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = query_timeout
+        return super().send(request, **kwargs)
+
+def close_session(key):
+    # call with sessions_lock held
+    sessions.pop(key)["api"].session.close()
+
+def retire_session(key):
+    # call with sessions_lock held
+    if sessions[key]["users"] <= 0:
+        close_session(key)
+    else:
+        retired_sessions.append(sessions.pop(key))
+
+def get_api(scene_label, renew=False):
+    # returns (api, reused) from the session pool, keyed by hub and user
+    key = (scenes[scene_label]["hub-url"], scenes[scene_label]["username"])
+    now = datetime.datetime.utcnow()
+    with sessions_lock:
+        if key in sessions:
+            if renew or sessions[key]["password"] != scenes[scene_label]["password"] or now - sessions[key]["created"] > session_max_age:
+                retire_session(key)
+            else:
+                sessions[key]["users"] += 1
+                sessions[key]["last-used"] = now
+                return sessions[key]["api"], True
+        api = SentinelAPI(scenes[scene_label]["username"], scenes[scene_label]["password"], scenes[scene_label]["hub-url"])
+        # keep enough pooled connections for the parallel scenes, downloads and queries of the hub
+        adapter = TimeoutHTTPAdapter(pool_maxsize=hub_limits.get(key[0],hub_concurrency)*api.concurrent_dl_limit+query_workers)
+        api.session.mount("https://", adapter)
+        api.session.mount("http://", adapter)
+        # the hub limits the parallel downloads of a user; sentinelsat keeps its own semaphore of the same size
+        # for the queries and product info, so that the queries are not held up by the downloads
+        api.download_semaphore = download_semaphores.setdefault(key, threading.BoundedSemaphore(api.concurrent_dl_limit))
+        sessions[key] = {"api": api, "password": scenes[scene_label]["password"], "created": now, "last-used": now, "users": 1}
+        count_metric("sentsync_logins_total", hub=key[0])
+        return api, False
+
+def release_api(api):
+    with sessions_lock:
+        for key in sessions:
+            if sessions[key]["api"] is api:
+                sessions[key]["users"] -= 1
+                sessions[key]["last-used"] = datetime.datetime.utcnow()
+                return
+        for session in retired_sessions:
+            if session["api"] is api:
+                session["users"] -= 1
+                if session["users"] <= 0:
+                    retired_sessions.remove(session)
+                    api.session.close()
+                return
+
+def cleanup_sessions():
+    now = datetime.datetime.utcnow()
+    with sessions_lock:
+        for key in list(sessions):
+            if sessions[key]["users"] <= 0 and now - sessions[key]["last-used"] > session_idle_time:
+                write2log(parent_log_path,severity="INFO",description="Closing idle session to the hub %s." % key[0])
+                close_session(key)
+
+index_locks = {}
+
+def open_index(target_dir, rescan=False):
+    # product index of the target directory, rescanned if the directory was changed by someone else
+    index = sqlite3.connect(os.path.join(target_dir,index_filename), timeout=60, isolation_level=None, check_same_thread=False)
+    # the connection is shared by the download workers of the scene
+    index_locks[index] = threading.RLock()
+    # keep the journal file, creating and deleting it would change the directory mtime
+    index.execute("PRAGMA journal_mode=TRUNCATE")
+    index.execute("CREATE TABLE IF NOT EXISTS products (filename TEXT PRIMARY KEY, uuid TEXT, size INTEGER, md5 TEXT, sensing_time TEXT, downloaded_time TEXT, footprint TEXT)")
+    # indexes made by older versions
+    if "footprint" not in [column[1] for column in index.execute("PRAGMA table_info(products)")]:
+        index.execute("ALTER TABLE products ADD COLUMN footprint TEXT")
+    index.execute("CREATE INDEX IF NOT EXISTS products_uuid ON products (uuid)")
+    index.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+    index.execute("CREATE TABLE IF NOT EXISTS failures (uuid TEXT PRIMARY KEY, title TEXT, attempts INTEGER, last_attempt TEXT, last_error TEXT)")
+    # run state of the scenes using the directory, kept over restarts
+    index.execute("CREATE TABLE IF NOT EXISTS scenes (scene TEXT, query TEXT, last_run_time TEXT, last_full_query TEXT, watermarks TEXT, PRIMARY KEY (scene, query))")
+    index.execute("CREATE TABLE IF NOT EXISTS extents (scene TEXT, query TEXT, start TEXT, end TEXT, completed_time TEXT, PRIMARY KEY (scene, query, start, end))")
+    refresh_index(index, target_dir, rescan)
+    return index
+
+def close_index(index):
+    index_locks.pop(index)
+    index.close()
+
+def refresh_index(index, target_dir, rescan=False):
+    with index_locks[index]:
+        row = index.execute("SELECT value FROM meta WHERE key = 'dir-mtime'").fetchone()
+        if rescan or row is None or row[0] != str(os.stat(target_dir).st_mtime_ns):
+            rescan_index(index, target_dir)
+
+def is_index_file(filename):
+    return filename.startswith(index_filename)
+
+def rescan_index(index, target_dir):
+    # add files not in the index and forget removed ones, metadata of unchanged files is kept
+    files = {}
+    for filename in os.listdir(target_dir):
+        if os.path.splitext(filename)[1] == ".zip":
+            files[filename] = os.stat(os.path.join(target_dir,filename)).st_size
+    with index_locks[index]:
+        index.execute("BEGIN IMMEDIATE")
+        indexed = {filename: (size, sensing_time) for filename, size, sensing_time in index.execute("SELECT filename, size, sensing_time FROM products").fetchall()}
+        for filename in indexed:
+            size, sensing_time = indexed[filename]
+            if filename not in files or (size is not None and size != files[filename]):
+                index.execute("DELETE FROM products WHERE filename = ?", (filename,))
+                # a product removed by someone else makes its date extent incomplete
+                if sensing_time is not None:
+                    index.execute("DELETE FROM extents WHERE start <= ? AND end >= ?", (sensing_time, sensing_time))
+        index.executemany("INSERT OR IGNORE INTO products (filename, size) VALUES (?, ?)", files.items())
+        index.execute("COMMIT")
+        touch_index(index, target_dir)
+
+def touch_index(index, target_dir):
+    # directory changes made by us are already in the index
+    with index_locks[index]:
+        index.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('dir-mtime', ?)", (str(os.stat(target_dir).st_mtime_ns),))
+
+def indexed_files(index):
+    with index_locks[index]:
+        return index.execute("SELECT filename, sensing_time FROM products").fetchall()
+
+def product_filenames(props):
+    # file names a product may have in the target directory
+    return [props[key] + '.zip' for key in ["filename", "title"] if key in props]
+
+def is_indexed(index, product, props):
+    filenames = product_filenames(props)
+    query = "SELECT 1 FROM products WHERE uuid = ? OR filename IN (%s) LIMIT 1" % ",".join("?" * len(filenames))
+    with index_locks[index]:
+        return index.execute(query, [product] + filenames).fetchone() is not None
+
+def add_to_index(index, product, product_info, props):
+    sensing_time = props["beginposition"] if "beginposition" in props else product_info.get("date")
+    with index_locks[index]:
+        index.execute("INSERT OR REPLACE INTO products (filename, uuid, size, md5, sensing_time, downloaded_time, footprint) VALUES (?, ?, ?, ?, ?, ?, ?)", (
+            os.path.basename(product_info["path"]),
+            product,
+            product_info.get("size"),
+            product_info.get("md5"),
+            sensing_time.isoformat() if sensing_time is not None else None,
+            datetime.datetime.utcnow().isoformat(),
+            props["footprint"] if "footprint" in props else product_info.get("footprint"),
+        ))
+        index.execute("DELETE FROM failures WHERE uuid = ?", (product,))
+
+def add_metadata_to_index(index, filename, product, props):
+    # metadata of a file that was not downloaded by us
+    with index_locks[index]:
+        index.execute("UPDATE products SET uuid = ?, sensing_time = ?, footprint = ? WHERE filename = ?", (
+            product, props["beginposition"].isoformat(), props.get("footprint"), filename,
+        ))
+
+def remove_from_index(index, filename):
+    with index_locks[index]:
+        index.execute("DELETE FROM products WHERE filename = ?", (filename,))
+
+def add_failure(index, product, props, error):
+    with index_locks[index]:
+        index.execute("INSERT INTO failures (uuid, title, attempts, last_attempt, last_error) VALUES (?, ?, 1, ?, ?) ON CONFLICT (uuid) DO UPDATE SET attempts = attempts + 1, last_attempt = excluded.last_attempt, last_error = excluded.last_error", (
+            product, props.get("title"), datetime.datetime.utcnow().isoformat(), repr(error),
+        ))
+
+def is_failing(index, product):
+    # failed too many times, until the cooldown has passed
+    with index_locks[index]:
+        row = index.execute("SELECT attempts, last_attempt FROM failures WHERE uuid = ?", (product,)).fetchone()
+    return row is not None and row[0] >= max_product_failures and datetime.datetime.utcnow() - datetime.datetime.fromisoformat(row[1]) < product_failure_cooldown
+
+def scene_query_key(scene_label):
+    # the state of a scene applies only to the same queries
+    return hashlib.sha1(json.dumps([scenes[scene_label][arg] for arg in ["hub-url","wkt","product"]]).encode()).hexdigest()
+
+def load_scene_state(scene_label):
+    # last run, last full query and watermarks saved by an earlier run
+    try:
+        index = open_index(scenes[scene_label]["target-dir"])
+    except Exception as e:
+        write2log(parent_log_path,severity="WARNING",description="Cannot read the state of the scene %s: %s" % (scene_label, repr(e)))
+        return
+    try:
+        with index_locks[index]:
+            row = index.execute("SELECT last_run_time, last_full_query, watermarks FROM scenes WHERE scene = ? AND query = ?", (scene_label, scene_query_key(scene_label))).fetchone()
+    finally:
+        close_index(index)
+    if row is None:
+        return
+    scenes[scene_label]["last-run-time"] = datetime.datetime.fromisoformat(row[0]) if row[0] is not None else None
+    scenes[scene_label]["last-full-query"] = datetime.datetime.fromisoformat(row[1]) if row[1] is not None else None
+    scenes[scene_label]["watermarks"] = {
+        (datetime.datetime.fromisoformat(start), datetime.datetime.fromisoformat(end)): datetime.datetime.fromisoformat(watermark)
+        for start, end, watermark in json.loads(row[2])
+    }
+
+def save_scene_state(index, scene_label):
+    scene = scenes[scene_label]
+    with index_locks[index]:
+        index.execute("INSERT OR REPLACE INTO scenes (scene, query, last_run_time, last_full_query, watermarks) VALUES (?, ?, ?, ?, ?)", (
+            scene_label, scene_query_key(scene_label),
+            scene["last-run-time"].isoformat() if scene["last-run-time"] is not None else None,
+            scene["last-full-query"].isoformat() if scene["last-full-query"] is not None else None,
+            json.dumps([(start.isoformat(), end.isoformat(), watermark.isoformat()) for (start, end), watermark in scene["watermarks"].items()]),
+        ))
+
+def is_extent_complete(index, scene_label, date_extent):
+    with index_locks[index]:
+        return index.execute("SELECT 1 FROM extents WHERE scene = ? AND query = ? AND start = ? AND end = ?", (
+            scene_label, scene_query_key(scene_label), date_extent[0].isoformat(), date_extent[1].isoformat()
+        )).fetchone() is not None
+
+def add_complete_extent(index, scene_label, date_extent):
+    with index_locks[index]:
+        index.execute("INSERT OR REPLACE INTO extents (scene, query, start, end, completed_time) VALUES (?, ?, ?, ?, ?)", (
+            scene_label, scene_query_key(scene_label), date_extent[0].isoformat(), date_extent[1].isoformat(), datetime.datetime.utcnow().isoformat()
+        ))
+
+def invalidate_extents(scene_label):
+    index = open_index(scenes[scene_label]["target-dir"])
+    try:
+        with index_locks[index]:
+            num_extents = index.execute("DELETE FROM extents WHERE scene = ?", (scene_label,)).rowcount
+    finally:
+        close_index(index)
+    return num_extents
+
+def merge_extents(date_extents):
+    # overlapping and adjacent (to the second) date extents are queried as one
+    merged = []
+    for date_extent in sorted(date_extents):
+        if len(merged) > 0 and date_extent[0] <= merged[-1][1] + datetime.timedelta(seconds=1):
+            merged[-1] = (merged[-1][0], max(merged[-1][1], date_extent[1]))
+        else:
+            merged.append(date_extent)
+    return merged
+
+def scene_date_extents(scene_label, run_time):
+    run_day = datetime.datetime(run_time.year,run_time.month,run_time.day)
+
+    date_extents = []
+    if scenes[scene_label]["day-range"] is not None:
+        date_extents = [list(scenes[scene_label]["day-range"])]
+        date_extents[0][1] += datetime.timedelta(days=1,seconds=-1)
+        date_extents[0] = tuple(date_extents[0])
+
+    if scenes[scene_label]["day"] is not None:
+        for day in scenes[scene_label]["day"]:
+            date_extents.append((day, day + datetime.timedelta(days=1,seconds=-1)))
+
+    if scenes[scene_label]["day-offset"] is not None:
+        for day_offset in scenes[scene_label]["day-offset"]:
+            day = run_day + datetime.timedelta(days=day_offset)
+            date_extents.append((day, day + datetime.timedelta(days=1,seconds=-1)))
+
+    date_extents = merge_extents(date_extents)
+    if scenes[scene_label]["day-range"] is not None:
+        date_extents = split_extent(date_extents[0], scenes[scene_label]["chunk-days"])
+    return date_extents
+
+def split_extent(date_extent, days):
+    chunks = []
+    start = date_extent[0]
+    while start <= date_extent[1]:
+        chunks.append((start, min(start + datetime.timedelta(days=days,seconds=-1), date_extent[1])))
+        start += datetime.timedelta(days=days)
+    return chunks
 
+query_areas = {}
+query_areas_lock = threading.Lock()
+
+def query_area(scene_label):
+    # (wkts sent to the hub, exact area to filter the products or None), computed once per area
+    key = (scenes[scene_label]["wkt"], scenes[scene_label]["query-vertices"])
+    with query_areas_lock:
+        if key not in query_areas:
+            query_areas[key] = make_query_area(*key)
+            parts, area = query_areas[key]
+            if area is not None:
+                write2log(parent_log_path,severity="INFO",description="The area of the scene %s is queried as %s polygons of %s vertices (the area has %s vertices)." % (
+                    scene_label, len(parts), sum(shapely.get_num_coordinates(shapely.from_wkt(part)) for part in parts), shapely.get_num_coordinates(area)), scene=scene_label)
+        return query_areas[key]
+
+def make_query_area(wkt, max_vertices):
+    if shapely is None:
+        return [wkt], None
+    try:
+        area = shapely.from_wkt(wkt)
+    except Exception:
+        # sent as is, the hub tells what is wrong
+        return [wkt], None
+    polygons = list(get_parts(area))
+    if len(polygons) > max_query_parts:
+        polygons = [area.convex_hull]
+    if max_vertices == 0 or (len(polygons) == 1 and shapely.get_num_coordinates(area) <= max_vertices):
+        # nothing to gain
+        return [wkt], None
+    parts = []
+    for polygon in polygons:
+        if shapely.get_num_coordinates(polygon) <= max_vertices:
+            parts.append(shapely.to_wkt(polygon, rounding_precision=-1))
+        else:
+            parts.append(simplify_covering(polygon, max_vertices))
+    if None in parts or not shapely.union_all([shapely.from_wkt(part) for part in parts]).covers(area):
+        write2log(parent_log_path,severity="WARNING",description="No covering of the area with %s vertices was found, the area is queried as it is: %s" % (max_vertices, wkt))
+        return [wkt], None
+    shapely.prepare(area)
+    return parts, area
+
+def covering_wkt(covering, polygon):
+    # the wkt is rounded to 6 decimals, which may move a vertex touching the polygon inside it; None if it does not cover anymore
+    wkt = shapely.to_wkt(covering, rounding_precision=6)
+    if shapely.from_wkt(wkt).covers(polygon):
+        return wkt
+    return None
+
+def simplify_covering(polygon, max_vertices):
+    # returns the wkt of a covering of the polygon with at most max_vertices vertices
+    # simplifying the polygon widened by the tolerance keeps it covered, the tolerance grows until the vertices are few enough
+    size = max(polygon.bounds[2] - polygon.bounds[0], polygon.bounds[3] - polygon.bounds[1])
+    tolerance = size / 1000
+    while tolerance < size:
+        covering = polygon.buffer(tolerance, join_style="mitre").simplify(tolerance / 2)
+        # holes do not matter for a covering
+        covering = shapely.Polygon(covering.exterior)
+        if shapely.get_num_coordinates(covering) <= max_vertices:
+            wkt = covering_wkt(covering, polygon)
+            if wkt is not None:
+                return wkt
+        tolerance *= 2
+    if shapely.get_num_coordinates(polygon.convex_hull) <= max_vertices:
+        wkt = covering_wkt(polygon.convex_hull, polygon)
+        if wkt is not None:
+            return wkt
+    # widened by more than the rounding
+    west, south, east, north = polygon.bounds
+    return covering_wkt(shapely.box(west - 1e-6, south - 1e-6, east + 1e-6, north + 1e-6), polygon)
+
+def outside_area(area, props):
+    # exact test of the footprint, products without a readable footprint are kept
+    if area is None or "footprint" not in props:
+        return False
+    try:
+        footprint = shapely.from_wkt(props["footprint"])
+        with query_areas_lock:
+            return not area.intersects(footprint)
+    except Exception:
+        return False
+
+def map_parts(function, parts):
+    # the parts of a split area are queried in parallel, results in the order of the parts
+    if len(parts) == 1:
+        return [function(parts[0])]
+    with ThreadPoolExecutor(max_workers=min(len(parts), query_part_workers)) as part_executor:
+        return list(part_executor.map(function, parts))
+
+def plan_queries(scene_labels, run_time):
+    # full queries of the scenes, identical ones of different scenes combined
+    plan = {}
+    for scene_label in scene_labels:
+        for date_extent in scene_date_extents(scene_label, run_time):
+            key = (scenes[scene_label]["hub-url"], scenes[scene_label]["wkt"], scenes[scene_label]["product"], date_extent)
+            plan.setdefault(key, []).append(scene_label)
+    return plan
+
+def print_plan(run_time):
+    plan = plan_queries(list(scenes), run_time)
+    num_extents = sum(len(scene_labels) for scene_labels in plan.values())
+    print("%s queries planned for %s scene date extents." % (len(plan), num_extents))
+    total_products = 0
+    total_requests = 0
+    for hub_url, wkt, product, date_extent in sorted(plan, key=lambda key: (key[0], key[2], key[3])):
+        scene_label = plan[(hub_url, wkt, product, date_extent)][0]
+        try:
+            api, _ = get_api(scene_label)
+            try:
+                # overlapping parts of a split area count some products twice
+                count = sum(api.count(area = part, producttype = product, date = date_extent) for part in query_area(scene_label)[0])
+            finally:
+                release_api(api)
+            # one request per result page, at least one
+            requests = max(math.ceil(count / api.page_size), 1)
+            total_products += count
+            total_requests += requests
+            cost = "%s products, %s requests" % (count, requests)
+        except Exception as e:
+            cost = "cost unknown: %s" % repr(e)
+        print("- %s %s %s - %s (%s): %s" % (hub_url, product, date_extent[0].strftime("%Y%m%dT%H%M%S"), date_extent[1].strftime("%Y%m%dT%H%M%S"), ", ".join(plan[(hub_url, wkt, product, date_extent)]), cost))
+    print("Estimated total: %s products, %s query requests." % (total_products, total_requests))
+
+def run_scene(scene_label, run_time):
+    # returns False if the hub gave login or server errors, None if the queries of the scene were not accepted
+    date_extents = scene_date_extents(scene_label, run_time)
+    start_time = datetime.datetime.utcnow()
+
+    write2log(parent_log_path,severity="INFO",description="Processing download of %s products for the scene \"%s\". Scene options:" % (scenes[scene_label]["product"],scene_label.replace("|"+scenes[scene_label]["product"],"")))
+    write2log(parent_log_path,severity="INFO",description="- Area: %s" % scenes[scene_label]["wkt"])
+    for date_extent in date_extents:
+        write2log(parent_log_path,severity="INFO",description="- Date range: %s - %s" % (date_extent[0].strftime("%Y%m%dT%H%M%S"), date_extent[1].strftime("%Y%m%dT%H%M%S")))
+    write2log(parent_log_path,severity="INFO",description="- Hub: %s" % scenes[scene_label]["hub-url"])
+    write2log(parent_log_path,severity="INFO",description="- Target directory: %s" % scenes[scene_label]["target-dir"])
+    write2log(parent_log_path,severity="INFO",description="- Log file: %s" % scenes[scene_label]["log-file"])
+
+    try:
+        api, reused = get_api(scene_label)
+    except:
+        # TODO include API error to log
+        write2log(scenes[scene_label]["log-file"],severity="ERROR",description="Error in logging in. Skipping scene.")
+        write2log(parent_log_path,severity="ERROR",description="Error in logging in. See log file at %s. Skipping scene." % scenes[scene_label]["log-file"], scene=scene_label, hub=scenes[scene_label]["hub-url"])
+        return False
+    if reused:
+        write2log(scenes[scene_label]["log-file"],severity="INFO",description="Reusing the session to the hub %s" % scenes[scene_label]["hub-url"])
+    else:
         write2log(scenes[scene_label]["log-file"],severity="INFO",description="Logging into the hub %s" % scenes[scene_label]["hub-url"])
+
+    # reruns query only recently ingested products, except every full-query-interval
+    full_query = scenes[scene_label]["last-full-query"] is None or run_time - scenes[scene_label]["last-full-query"] >= datetime.timedelta(seconds=scenes[scene_label]["full-query-interval"])
+    if full_query:
+        scenes[scene_label]["last-full-query"] = run_time
+    # forget the watermarks of extents not in use anymore (day-offset)
+    for date_extent in list(scenes[scene_label]["watermarks"]):
+        if date_extent not in date_extents:
+            del scenes[scene_label]["watermarks"][date_extent]
+
+    try:
+        run_scene_extents(scene_label, api, date_extents, full_query)
+    except UnauthorizedError:
+        write2log(scenes[scene_label]["log-file"],severity="ERROR",description="Error in logging in. Skipping scene.")
+        write2log(parent_log_path,severity="ERROR",description="Error in logging in. See log file at %s. Skipping scene." % scenes[scene_label]["log-file"], scene=scene_label, hub=scenes[scene_label]["hub-url"])
+        return False
+    except (SentinelAPIError, RequestException) as e:
+        count_metric("sentsync_query_errors_total", scene=scene_label, hub=scenes[scene_label]["hub-url"])
+        write2log(scenes[scene_label]["log-file"],severity="ERROR",description="Error in querying the hub: %s. Skipping scene." % repr(e), scene=scene_label, hub=scenes[scene_label]["hub-url"])
+        write2log(parent_log_path,severity="ERROR",description="Error in querying the hub. See log file at %s. Skipping scene." % scenes[scene_label]["log-file"], scene=scene_label, hub=scenes[scene_label]["hub-url"])
+        # other errors (e.g. a query syntax error) are of the scene, the hub is not backed off for them
+        if isinstance(e, (ServerError, RequestException)):
+            return False
+        return None
+    finally:
+        release_api(api)
+
+    seconds = (datetime.datetime.utcnow() - start_time).total_seconds()
+    write2log(parent_log_path,severity="INFO",description="Completed. Further information in the log file.",
+        scene=scene_label, seconds=seconds)
+    count_metric("sentsync_scene_runs_total", scene=scene_label)
+    observe_metric("sentsync_scene_run_seconds", seconds, scene=scene_label)
+    set_metric("sentsync_last_success_timestamp_seconds", datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc).timestamp(), scene=scene_label)
+    return True
+
+query_rate_condition = threading.Condition()
+query_rate_buckets = {}
+
+def wait_query_rate(hub_url):
+    # token bucket per hub, holding at most one second of queries
+    rate = hub_query_rates.get(hub_url, hub_query_rate)
+    if rate is None:
+        return
+    with query_rate_condition:
+        while True:
+            now = perf_counter()
+            bucket = query_rate_buckets.setdefault(hub_url, {"queries": max(rate, 1), "time": now})
+            bucket["queries"] = min(max(rate, 1), bucket["queries"] + (now - bucket["time"]) * rate)
+            bucket["time"] = now
+            if bucket["queries"] >= 1:
+                bucket["queries"] -= 1
+                return
+            query_rate_condition.wait((1 - bucket["queries"]) / rate)
+
+def query_hub(scene_label, api, **query):
+    # api.query, logging in again once if the hub does not accept the session anymore
+    # server errors and timeouts are retried, the queries to a hub are rate limited
+    start_time = datetime.datetime.utcnow()
+    # the session of the caller is handed over to the renewed one if the query succeeds, it is kept otherwise
+    caller_api = api
+    attempt = 0
+    try:
+        while True:
+            wait_query_rate(scenes[scene_label]["hub-url"])
+            try:
+                products = api.query(**query)
+                break
+            except UnauthorizedError:
+                if api is not caller_api:
+                    raise
+                write2log(scenes[scene_label]["log-file"],severity="WARNING",description="Session to the hub %s was not accepted. Logging in again." % scenes[scene_label]["hub-url"],
+                    scene=scene_label, hub=scenes[scene_label]["hub-url"])
+                api, _ = get_api(scene_label, renew=True)
+            except (ServerError, RequestException) as e:
+                attempt += 1
+                if attempt > query_retries:
+                    raise
+                delay = query_retry_delay * 2 ** (attempt - 1)
+                count_metric("sentsync_query_retries_total", scene=scene_label, hub=scenes[scene_label]["hub-url"])
+                write2log(scenes[scene_label]["log-file"],severity="WARNING",description="Error in querying the hub: %s. Retrying in %s seconds." % (repr(e), delay),
+                    scene=scene_label, hub=scenes[scene_label]["hub-url"], extent=query.get("date"))
+                sleep(delay)
+    except Exception:
+        if api is not caller_api:
+            release_api(api)
+        raise
+    if api is not caller_api:
+        release_api(caller_api)
+    seconds = (datetime.datetime.utcnow() - start_time).total_seconds()
+    observe_metric("sentsync_query_seconds", seconds, scene=scene_label, hub=scenes[scene_label]["hub-url"])
+    count_metric("sentsync_query_products_total", len(products), scene=scene_label, hub=scenes[scene_label]["hub-url"])
+    write2log(scenes[scene_label]["log-file"],severity="INFO",description="The hub returned %s products in %.1f seconds." % (len(products), seconds),
+        scene=scene_label, hub=scenes[scene_label]["hub-url"], extent=query.get("date"), offset=query.get("offset",0), products=len(products), seconds=seconds)
+    return api, products
+
+shared_queries = {}
+shared_queries_lock = threading.Lock()
+
+def shared_query(scene_label, api, **query):
+    # query_hub, but scenes sending the same query at about the same time share one request
+    key = (scenes[scene_label]["hub-url"], scenes[scene_label]["username"]) + tuple(sorted((arg, repr(value)) for arg, value in query.items()))
+    now = datetime.datetime.utcnow()
+    with shared_queries_lock:
+        if key in shared_queries and now - shared_queries[key][1] < query_share_time:
+            future, owner = shared_queries[key][0], False
+        else:
+            future, owner = Future(), True
+            shared_queries[key] = (future, now)
+    if owner:
         try:
-            api = SentinelAPI(scenes[scene_label]["username"], scenes[scene_label]["password"], scenes[scene_label]["hub-url"])
-        except:
-            # TODO include API error to log
-            write2log(scenes[scene_label]["log-file"],severity="ERROR",description="Error in logging in. Skipping scene.")
-            write2log(parent_log_path,severity="ERROR",description="Error in logging in. See log file at %s. Skipping scene." % scenes[scene_label]["log-file"])
-            continue
+            api, products = query_hub(scene_label, api, **query)
+            future.set_result(products)
+        except Exception as e:
+            future.set_exception(e)
+            with shared_queries_lock:
+                if key in shared_queries and shared_queries[key][0] is future:
+                    del shared_queries[key]
+            raise
+    else:
+        write2log(scenes[scene_label]["log-file"],severity="INFO",description="Using the result of the same query made by another scene.")
+        products = future.result()
+    # the scenes modify their product lists
+    return api, deepcopy(products)
 
-        for date_extent in date_extents:
+def cleanup_shared_queries():
+    now = datetime.datetime.utcnow()
+    with shared_queries_lock:
+        for key in list(shared_queries):
+            if shared_queries[key][0].done() and now - shared_queries[key][1] >= query_share_time:
+                del shared_queries[key]
+
+def run_scene_extents(scene_label, api, date_extents, full_query):
+    index = open_index(scenes[scene_label]["target-dir"])
+    try:
+        run_scene_extents_indexed(scene_label, api, date_extents, full_query, index)
+    finally:
+        close_index(index)
+
+def run_scene_extents_indexed(scene_label, api, date_extents, full_query, index):
+    # the queries of all date extents are sent at once, the downloads follow extent by extent
+    queries = {}
+    for date_extent in date_extents:
+        # completed and settled extents are not queried again
+        if is_extent_complete(index, scene_label, date_extent):
+            write2log(scenes[scene_label]["log-file"],severity="INFO",description="Products from %s to %s are already downloaded. Skipping." % (
+                date_extent[0].strftime("%Y%m%dT%H%M%S"), date_extent[1].strftime("%Y%m%dT%H%M%S")
+            ), scene=scene_label, extent=date_extent)
+            continue
+        query = {
+            "area" : scenes[scene_label]["wkt"],
+            "producttype" : scenes[scene_label]["product"],
+            "date" : date_extent
+        }
+        if not full_query and date_extent in scenes[scene_label]["watermarks"]:
+            ingested_after = scenes[scene_label]["watermarks"][date_extent] - datetime.timedelta(seconds=scenes[scene_label]["watermark-overlap"])
+            query["ingestiondate"] = (ingested_after, None)
+            write2log(scenes[scene_label]["log-file"],severity="INFO",description="Requesting %s products from %s to %s in given WKT, ingested after %s." % (
+                scenes[scene_label]["product"], date_extent[0].strftime("%Y%m%dT%H%M%S"), date_extent[1].strftime("%Y%m%dT%H%M%S"), ingested_after.strftime("%Y%m%dT%H%M%S")
+            ), scene=scene_label, extent=date_extent, ingested_after=ingested_after)
+        else:
             write2log(scenes[scene_label]["log-file"],severity="INFO",description="Requesting %s products from %s to %s in given WKT." % (
                 scenes[scene_label]["product"], date_extent[0].strftime("%Y%m%dT%H%M%S"), date_extent[1].strftime("%Y%m%dT%H%M%S")
+            ), scene=scene_label, extent=date_extent)
+        # day ranges can be long, their results are streamed to the downloads page by page when their turn comes
+        queries[date_extent] = (query, None if scenes[scene_label]["day-range"] is not None else submit_query(scene_label, query))
+
+    try:
+        for date_extent, (query, futures) in queries.items():
+            if futures is None:
+                api, watermark, complete = stream_extent(scene_label, api, query, index)
+            else:
+                api, watermark, complete = download_extent(scene_label, api, query, index, futures)
+
+            # latest ingestion seen, moved forward only if all products of the extent are downloaded
+            if complete and scenes[scene_label]["rerun-latency"] is not None and watermark is not None:
+                if date_extent not in scenes[scene_label]["watermarks"] or watermark > scenes[scene_label]["watermarks"][date_extent]:
+                    scenes[scene_label]["watermarks"][date_extent] = watermark
+            if complete and date_extent[1] < datetime.datetime.utcnow() - datetime.timedelta(days=scenes[scene_label]["settle-days"]):
+                add_complete_extent(index, scene_label, date_extent)
+            # an interrupted run continues from here
+            save_scene_state(index, scene_label)
+    finally:
+        # queries not sent yet are not needed anymore if the scene stopped
+        for query, futures in queries.values():
+            for future in futures or []:
+                future.cancel()
+    save_scene_state(index, scene_label)
+
+    if scenes[scene_label]["day-offset"] is not None and "day-rolling" in scenes[scene_label] and scenes[scene_label]["day-rolling"]:
+        remove_out_of_range(scene_label, date_extents, index)
+
+# one download arbiter for all scenes: token buckets of the bandwidth limits and the products pending per priority
+bandwidth_condition = threading.Condition()
+bandwidth_buckets = {}
+pending_downloads = {}
+# priorities of the scenes waiting for the download of a product (uuid) by another scene
+download_waiters = {}
+
+def download_priority(scene_label, product):
+    # call with bandwidth_condition held; a download has the highest priority of its scene and the scenes waiting for it
+    return min([scenes[scene_label]["priority"]] + download_waiters.get(product, []))
+
+def higher_priority_pending(scene_label, product):
+    # call with bandwidth_condition held
+    priority = download_priority(scene_label, product)
+    return any(count > 0 for other, count in pending_downloads.items() if other < priority)
+
+def download_paused(scene_label, product):
+    # call with bandwidth_condition held
+    return low_priority_bandwidth == 0 and higher_priority_pending(scene_label, product)
+
+def bandwidth_limits(scene_label, product):
+    # the buckets a download of the scene takes from, as {key: MB/s}
+    hub_url = scenes[scene_label]["hub-url"]
+    limits = {"total": bandwidth, "hub " + hub_url: hub_bandwidth_limits.get(hub_url, hub_bandwidth)}
+    if low_priority_bandwidth > 0 and higher_priority_pending(scene_label, product):
+        limits["priority %s" % download_priority(scene_label, product)] = low_priority_bandwidth
+    return {key: limit for key, limit in limits.items() if limit is not None}
+
+def add_pending_download(scene_label, count):
+    priority = scenes[scene_label]["priority"]
+    with bandwidth_condition:
+        pending_downloads[priority] = pending_downloads.get(priority, 0) + count
+        set_metric("sentsync_pending_downloads", pending_downloads[priority], priority=priority)
+        # lower priority downloads may go on
+        bandwidth_condition.notify_all()
+
+def wait_for_download(scene_label, product, wait):
+    # returns wait(), waiting for the download of the product by another scene;
+    # that download takes the priority of this scene meanwhile, so it is not paused for this scene's other downloads
+    priority = scenes[scene_label]["priority"]
+    with bandwidth_condition:
+        download_waiters.setdefault(product, []).append(priority)
+        bandwidth_condition.notify_all()
+    try:
+        return wait()
+    finally:
+        with bandwidth_condition:
+            download_waiters[product].remove(priority)
+            if len(download_waiters[product]) == 0:
+                del download_waiters[product]
+
+def wait_download_turn(scene_label, product):
+    # waits while the download is paused, woken up when the higher priority downloads are done
+    start_time = perf_counter()
+    with bandwidth_condition:
+        while download_paused(scene_label, product):
+            bandwidth_condition.wait(1)
+    waited = perf_counter() - start_time
+    if waited > 0.01:
+        count_metric("sentsync_bandwidth_wait_seconds_total", waited, scene=scene_label)
+
+def use_bandwidth(scene_label, product, nbytes):
+    # waits until nbytes may be downloaded, returns False if the download is to be paused instead;
+    # a bucket holds at most one second of its rate and may go below zero, so chunks larger than the rate are let through one by one
+    start_time = perf_counter()
+    with bandwidth_condition:
+        while True:
+            if download_paused(scene_label, product):
+                return False
+            now = perf_counter()
+            limits = bandwidth_limits(scene_label, product)
+            wait_time = 0
+            for key, limit in limits.items():
+                bucket = bandwidth_buckets.setdefault(key, {"bytes": limit * 1e6, "time": now})
+                bucket["bytes"] = min(limit * 1e6, bucket["bytes"] + (now - bucket["time"]) * limit * 1e6)
+                bucket["time"] = now
+                if bucket["bytes"] < 0:
+                    wait_time = max(wait_time, -bucket["bytes"] / (limit * 1e6))
+            if wait_time == 0:
+                for key in limits:
+                    bandwidth_buckets[key]["bytes"] -= nbytes
+                break
+            bandwidth_condition.wait(min(wait_time, 1))
+    waited = perf_counter() - start_time
+    if waited > 0.01:
+        count_metric("sentsync_bandwidth_wait_seconds_total", waited, scene=scene_label)
+    return True
+
+# paths being downloaded to, scenes sharing a target directory must not write the same partial file at once
+download_paths = {}
+download_paths_lock = threading.Lock()
+
+def lock_download_path(scene_label, product, path):
+    with download_paths_lock:
+        if path not in download_paths:
+            download_paths[path] = {"lock": threading.Lock(), "users": 0}
+        download_paths[path]["users"] += 1
+        lock = download_paths[path]["lock"]
+    if lock.acquire(blocking=False):
+        return
+    write2log(scenes[scene_label]["log-file"],severity="INFO",description="%s is being downloaded by another scene. Waiting for it." % os.path.basename(path),
+        scene=scene_label)
+    wait_for_download(scene_label, product, lock.acquire)
+
+def unlock_download_path(path):
+    with download_paths_lock:
+        download_paths[path]["lock"].release()
+        download_paths[path]["users"] -= 1
+        if download_paths[path]["users"] == 0:
+            del download_paths[path]
+
+def download_product(api, product, scene_label, target_dir):
+    # returns the product info with the path, the product is downloaded once if scenes share the target directory
+    product_info = api.get_product_odata(product)
+    if not product_info["Online"]:
+        api.trigger_offline_retrieval(product)
+        raise LTATriggered(product)
+    product_info["path"] = os.path.join(target_dir, product_info["title"] + ".zip")
+    # for the metrics
+    product_info["downloaded_bytes"] = 0
+    product_info["checksum_seconds"] = 0
+    lock_download_path(scene_label, product, product_info["path"])
+    try:
+        if os.path.exists(product_info["path"]) and os.path.getsize(product_info["path"]) == product_info["size"]:
+            # downloaded by another scene meanwhile
+            product_info["downloaded"] = False
+            return product_info
+        return write_product(api, product_info, scene_label)
+    finally:
+        unlock_download_path(product_info["path"])
+
+def write_product(api, product_info, scene_label):
+    # download to <title>.zip.incomplete, hashing the bytes while they are written
+    # an existing partial file is continued with a range request
+    temp_path = product_info["path"] + ".incomplete"
+    algorithm = "sha3-256" if "sha3-256" in product_info else "md5"
+    if algorithm not in product_info:
+        # a product that cannot be checked is not kept, as with the downloads of sentinelsat
+        raise InvalidChecksumError("No checksum information found in product information.")
+    checksum = hashlib.new(algorithm.replace("-","_"))
+
+    offset = 0
+    if os.path.exists(temp_path):
+        offset = os.path.getsize(temp_path)
+        if offset > product_info["size"]:
+            os.remove(temp_path)
+            offset = 0
+        else:
+            start_time = perf_counter()
+            with open(temp_path,"rb") as f:
+                for chunk in iter(lambda: f.read(download_chunk_size), b""):
+                    checksum.update(chunk)
+            product_info["checksum_seconds"] += perf_counter() - start_time
+
+    while offset < product_info["size"]:
+        # a paused download holds neither a connection nor a download slot, it is continued with a range request
+        wait_download_turn(scene_label, product_info["id"])
+        paused = False
+        with api.download_semaphore:
+            response = api.session.get(product_info["url"], stream=True, headers={"Range": "bytes=%s-" % offset} if offset > 0 else {}, timeout=api.session.timeout)
+            try:
+                response.raise_for_status()
+                if offset > 0 and response.status_code != 206:
+                    # the hub ignored the range, start over
+                    offset = 0
+                    checksum = hashlib.new(algorithm.replace("-","_"))
+                with open(temp_path, "ab" if offset > 0 else "wb") as f:
+                    for chunk in response.iter_content(chunk_size=download_chunk_size):
+                        paused = not use_bandwidth(scene_label, product_info["id"], len(chunk))
+                        f.write(chunk)
+                        start_time = perf_counter()
+                        checksum.update(chunk)
+                        product_info["checksum_seconds"] += perf_counter() - start_time
+                        product_info["downloaded_bytes"] += len(chunk)
+                        offset += len(chunk)
+                        if paused:
+                            break
+            finally:
+                response.close()
+        if not paused or offset >= product_info["size"]:
+            break
+        write2log(scenes[scene_label]["log-file"],severity="INFO",description="Download of %s paused at %s of %s bytes for higher priority downloads." % (product_info["title"], offset, product_info["size"]),
+            scene=scene_label, product=product_info["title"], offset=offset)
+
+    if offset != product_info["size"]:
+        # the partial file is kept and continued by the next attempt
+        raise RequestException("Download of %s ended at %s of %s bytes." % (product_info["title"], offset, product_info["size"]))
+    if checksum.hexdigest().lower() != product_info[algorithm].lower():
+        # the partial file is useless if the checksum does not match
+        os.remove(temp_path)
+        raise InvalidChecksumError("File corrupt: checksums do not match")
+    os.replace(temp_path, product_info["path"])
+    return product_info
+
+# shared product store: <product-store>/<uuid>/<title>.zip, recorded with its checksum and the target files linked to it
+stores = {}
+store_lock = threading.Lock()
+# products being downloaded into the store, other scenes wait for them
+store_downloads = {}
+last_store_prune = None
+# linux ioctl cloning a file (copy on write, e.g. btrfs, xfs)
+FICLONE = 0x40049409
+
+def open_store():
+    # call with store_lock held, one connection per store path
+    if product_store not in stores:
+        store = sqlite3.connect(os.path.join(product_store,store_filename), timeout=60, isolation_level=None, check_same_thread=False)
+        store.execute("PRAGMA journal_mode=WAL")
+        store.execute("CREATE TABLE IF NOT EXISTS products (uuid TEXT PRIMARY KEY, title TEXT, size INTEGER, algorithm TEXT, checksum TEXT, path TEXT, stored_time TEXT)")
+        store.execute("CREATE TABLE IF NOT EXISTS links (path TEXT PRIMARY KEY, uuid TEXT)")
+        store.execute("CREATE INDEX IF NOT EXISTS links_uuid ON links (uuid)")
+        stores[product_store] = store
+    return stores[product_store]
+
+def stored_product(product):
+    # the product info of a stored product or None, call with store_lock held
+    row = open_store().execute("SELECT title, size, algorithm, checksum, path FROM products WHERE uuid = ?", (product,)).fetchone()
+    if row is None:
+        return None
+    title, size, algorithm, checksum, path = row
+    if not os.path.exists(path) or os.path.getsize(path) != size:
+        # removed by someone else
+        open_store().execute("DELETE FROM products WHERE uuid = ?", (product,))
+        return None
+    return {"title": title, "size": size, algorithm: checksum, "path": path, "downloaded_bytes": 0, "checksum_seconds": 0}
+
+def store_product(scene_label, api, product):
+    # returns the product info of the stored product and whether it was downloaded by this call
+    with store_lock:
+        product_info = stored_product(product)
+        if product_info is not None:
+            return product_info, False
+        if product in store_downloads:
+            future, owner = store_downloads[product], False
+        else:
+            future, owner = Future(), True
+            store_downloads[product] = future
+    if not owner:
+        write2log(scenes[scene_label]["log-file"],severity="INFO",description="Product %s is being downloaded by another scene. Waiting for it." % product,
+            scene=scene_label, uuid=product)
+        count_metric("sentsync_store_waits_total", scene=scene_label)
+        # the error of the other scene counts as an attempt of this one
+        return dict(wait_for_download(scene_label, product, future.result), downloaded_bytes=0, checksum_seconds=0), False
+    try:
+        os.makedirs(os.path.join(product_store, product), exist_ok=True)
+        product_info = download_product(api, product, scene_label, os.path.join(product_store, product))
+        algorithm = "sha3-256" if "sha3-256" in product_info else "md5"
+        with store_lock:
+            open_store().execute("INSERT OR REPLACE INTO products (uuid, title, size, algorithm, checksum, path, stored_time) VALUES (?, ?, ?, ?, ?, ?, ?)", (
+                product, product_info["title"], product_info["size"], algorithm, product_info.get(algorithm), product_info["path"], datetime.datetime.utcnow().isoformat(),
             ))
-            
-            products = api.query(
-                area = scenes[scene_label]["wkt"],
-                producttype = scenes[scene_label]["product"], 
-                date = date_extent
-            )
-
-            write2log(scenes[scene_label]["log-file"],severity="INFO",description="%s products found." % len(products))
-
-            write2log(scenes[scene_label]["log-file"],severity="INFO",description="Checking if products exist.")
-            for product, filename in [(product,products[product]['filename']) for product in products]:
-                if filename + '.zip' in os.listdir(scenes[scene_label]["target-dir"]):
-                    del products[product]
-            write2log(scenes[scene_label]["log-file"],severity="INFO",description="Existing products removed from the list. %s new products found." % len(products))
-            
-            if (len(products)) == 0:
-                write2log(scenes[scene_label]["log-file"],severity="INFO",description="Nothing to download.")
+        future.set_result(product_info)
+        return product_info, True
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with store_lock:
+            del store_downloads[product]
+
+def link_file(source, target):
+    # the first link method that works, returns its name
+    temp_path = target + ".link"
+    for method in store_link_methods:
+        try:
+            if method == "hardlink":
+                os.link(source, temp_path)
+            elif method == "reflink":
+                with open(source,"rb") as src, open(temp_path,"wb") as dst:
+                    fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
             else:
-                try:
-                    write2log(scenes[scene_label]["log-file"],severity="INFO",description="Starting the download of %s products" % len(products))
-                    api.download_all(products, scenes[scene_label]["target-dir"], max_attempts=2,checksum=True)
-                    write2log(scenes[scene_label]["log-file"],severity="INFO",description="Download is complete.")
-                except:
-                    # TODO include download log/error to log
-                    write2log(scenes[scene_label]["log-file"],severity="ERROR",description="Error in downloading. Skipping download.")
-                    write2log(parent_log_path,severity="ERROR",description="Error in downloading. See log file at %s. Skipping download." % scenes[scene_label]["log-file"])
-                    continue
+                shutil.copyfile(source, temp_path)
+            os.replace(temp_path, target)
+            return method
+        except OSError as e:
+            error = e
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+    raise error
+
+def fetch_product(scene_label, api, product):
+    # download_product, or through the product store if there is one; returns the product info with the path in the target directory
+    if product_store is None:
+        return download_product(api, product, scene_label, scenes[scene_label]["target-dir"])
+    product_info, downloaded = store_product(scene_label, api, product)
+    path = os.path.join(scenes[scene_label]["target-dir"], product_info["title"] + ".zip")
+    method = link_file(product_info["path"], path)
+    with store_lock:
+        open_store().execute("INSERT OR REPLACE INTO links (path, uuid) VALUES (?, ?)", (path, product))
+    count_metric("sentsync_store_links_total", scene=scene_label, method=method)
+    if not downloaded:
+        write2log(scenes[scene_label]["log-file"],severity="INFO",description="Product %s is in the product store, linked it (%s)." % (product_info["title"], method),
+            scene=scene_label, product=product_info["title"], uuid=product)
+    return dict(product_info, path=path, downloaded=downloaded)
 
-            if scenes[scene_label]["day-offset"] is not None and "day-rolling" in scenes[scene_label] and scenes[scene_label]["day-rolling"]:
-                write2log(scenes[scene_label]["log-file"],severity="INFO",description="Removing products out of day-offset range (rolling sync)")
-                num_deleted = 0
-                for filename in os.listdir(scenes[scene_label]["target-dir"]):
-                    if os.path.join(scenes[scene_label]["target-dir"],filename) == scenes[scene_label]["log-file"]:
+def prune_store():
+    # forget links to removed target files, remove the products linked nowhere
+    global last_store_prune
+    now = datetime.datetime.utcnow()
+    if product_store is None or (last_store_prune is not None and now - last_store_prune < store_prune_time):
+        return
+    last_store_prune = now
+    num_pruned = 0
+    with store_lock:
+        store = open_store()
+        for path, product in store.execute("SELECT path, uuid FROM links").fetchall():
+            if not os.path.exists(path):
+                store.execute("DELETE FROM links WHERE path = ?", (path,))
+        orphans = store.execute("SELECT uuid, path FROM products WHERE stored_time < ? AND uuid NOT IN (SELECT uuid FROM links) AND uuid NOT IN (%s)" % ",".join("?" * len(store_downloads)),
+            [(now - store_prune_time).isoformat()] + list(store_downloads)).fetchall()
+        for product, path in orphans:
+            shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+            store.execute("DELETE FROM products WHERE uuid = ?", (product,))
+            num_pruned += 1
+    if num_pruned > 0:
+        count_metric("sentsync_store_pruned_total", num_pruned)
+        write2log(parent_log_path,severity="INFO",description="%s products removed from the product store %s, no target directory has them anymore." % (num_pruned, product_store))
+
+def download_and_index(scene_label, api, product, props, index):
+    # one product, failures are counted per product; returns True if downloaded
+    if is_failing(index, product):
+        write2log(scenes[scene_label]["log-file"],severity="WARNING",description="Product %s has failed %s times. Skipping it for now." % (props.get("title",product), max_product_failures),
+            scene=scene_label, product=props.get("title",product), uuid=product)
+        return False
+    for attempt in range(2):
+        start_time = datetime.datetime.utcnow()
+        try:
+            product_info = fetch_product(scene_label, api, product)
+            add_to_index(index, product, product_info, props)
+            seconds = (datetime.datetime.utcnow() - start_time).total_seconds()
+            if not product_info.get("downloaded", True):
+                return True
+            write2log(scenes[scene_label]["log-file"],severity="INFO",description="Downloaded %s in %.1f seconds." % (product_info["title"], seconds),
+                scene=scene_label, product=product_info["title"], uuid=product, size=product_info["size"], seconds=seconds)
+            count_metric("sentsync_downloaded_products_total", scene=scene_label, hub=scenes[scene_label]["hub-url"])
+            count_metric("sentsync_downloaded_bytes_total", product_info["downloaded_bytes"], scene=scene_label, hub=scenes[scene_label]["hub-url"])
+            observe_metric("sentsync_download_seconds", seconds, scene=scene_label, hub=scenes[scene_label]["hub-url"])
+            observe_metric("sentsync_checksum_seconds", product_info["checksum_seconds"], scene=scene_label)
+            if seconds > 0:
+                observe_metric("sentsync_download_speed_mb_per_second", product_info["downloaded_bytes"] / 1e6 / seconds, buckets=speed_buckets, scene=scene_label, hub=scenes[scene_label]["hub-url"])
+            return True
+        except LTATriggered:
+            write2log(scenes[scene_label]["log-file"],severity="INFO",description="Product %s is offline. Retrieval from the long term archive was triggered." % props.get("title",product),
+                scene=scene_label, product=props.get("title",product), uuid=product)
+            count_metric("sentsync_lta_retrievals_total", scene=scene_label, hub=scenes[scene_label]["hub-url"])
+            return False
+        except Exception as e:
+            error = e
+            count_metric("sentsync_download_errors_total", scene=scene_label, hub=scenes[scene_label]["hub-url"])
+            write2log(scenes[scene_label]["log-file"],severity="WARNING",description="Error in downloading %s (attempt %s): %s" % (props.get("title",product), attempt + 1, repr(e)),
+                scene=scene_label, product=props.get("title",product), uuid=product, seconds=(datetime.datetime.utcnow() - start_time).total_seconds())
+    add_failure(index, product, props, error)
+    count_metric("sentsync_products_failed_total", scene=scene_label)
+    write2log(scenes[scene_label]["log-file"],severity="ERROR",description="Error in downloading %s. Skipping the product." % props.get("title",product),
+        scene=scene_label, product=props.get("title",product), uuid=product)
+    return False
+
+def download_worker(scene_label, api, downloads, index, result):
+    while True:
+        item = downloads.get()
+        set_metric("sentsync_download_queue_depth", downloads.qsize(), scene=scene_label)
+        if item is None:
+            return
+        product, props = item
+        try:
+            if download_and_index(scene_label, api, product, props, index):
+                result["downloaded"].append(product)
+            else:
+                result["failed"].append(product)
+        except Exception as e:
+            # e.g. the index is locked; the worker goes on, otherwise the queue is not drained anymore
+            write2log(scenes[scene_label]["log-file"],severity="ERROR",description="Unexpected error in downloading %s: %s. Skipping the product." % (props.get("title",product), repr(e)),
+                scene=scene_label, product=props.get("title",product), uuid=product)
+            count_metric("sentsync_products_failed_total", scene=scene_label)
+            result["failed"].append(product)
+        finally:
+            add_pending_download(scene_label, -1)
+
+def queue_download(scene_label, downloads, product, props):
+    # counted as pending from here, so that lower priority downloads make way already
+    add_pending_download(scene_label, 1)
+    downloads.put((product, props))
+
+def start_download_workers(scene_label, api, index):
+    # returns the bounded download queue and the workers consuming it
+    downloads = queue.Queue(maxsize=download_queue_size)
+    result = {"downloaded": [], "failed": []}
+    workers = [threading.Thread(target=download_worker, args=(scene_label, api, downloads, index, result), daemon=True) for w in range(download_workers)]
+    for worker in workers:
+        worker.start()
+    return downloads, workers, result
+
+def stop_download_workers(downloads, workers):
+    # waits for the queued downloads
+    for worker in workers:
+        downloads.put(None)
+    for worker in workers:
+        worker.join()
+
+query_executor = None
+query_executor_workers = None
+query_executor_lock = threading.Lock()
+
+def get_query_executor():
+    # one pool for the queries of all scenes, made again if query-workers changed
+    global query_executor, query_executor_workers
+    with query_executor_lock:
+        if query_executor is None or query_executor_workers != query_workers:
+            if query_executor is not None:
+                query_executor.shutdown(wait=False)
+            query_executor = ThreadPoolExecutor(max_workers=query_workers)
+            query_executor_workers = query_workers
+        return query_executor
+
+def submit_query(scene_label, query):
+    # the query of a date extent, one future per part of the area
+    parts, _ = query_area(scene_label)
+    return [get_query_executor().submit(query_part, scene_label, part, query) for part in parts]
+
+def query_part(scene_label, part, query):
+    # shared_query of one part of the area, with its own session reference as the parts run in parallel
+    api, _ = get_api(scene_label)
+    try:
+        api, products = shared_query(scene_label, api, **dict(query, area=part))
+        return products
+    finally:
+        release_api(api)
+
+def download_extent(scene_label, api, query, index, futures):
+    # the query was submitted before (submit_query), returns (api, watermark, complete)
+    _, area = query_area(scene_label)
+    products = {}
+    for future in futures:
+        products.update(future.result())
+    if area is not None:
+        num_found = len(products)
+        for product in list(products):
+            if outside_area(area, products[product]):
+                del products[product]
+        write2log(scenes[scene_label]["log-file"],severity="INFO",description="%s products found in the query area, %s of them outside the area of the scene." % (num_found, num_found - len(products)))
+
+    write2log(scenes[scene_label]["log-file"],severity="INFO",description="%s products found." % len(products))
+
+    watermark = max([products[product]["ingestiondate"] for product in products if "ingestiondate" in products[product]], default=None)
+
+    write2log(scenes[scene_label]["log-file"],severity="INFO",description="Checking if products exist.")
+    refresh_index(index, scenes[scene_label]["target-dir"])
+    for product in list(products):
+        if is_indexed(index, product, products[product]):
+            del products[product]
+            count_metric("sentsync_products_existing_total", scene=scene_label)
+    write2log(scenes[scene_label]["log-file"],severity="INFO",description="Existing products removed from the list. %s new products found." % len(products))
+    
+    if (len(products)) == 0:
+        write2log(scenes[scene_label]["log-file"],severity="INFO",description="Nothing to download.")
+        return api, watermark, True
+
+    write2log(scenes[scene_label]["log-file"],severity="INFO",description="Starting the download of %s products" % len(products))
+    downloads, workers, result = start_download_workers(scene_label, api, index)
+    try:
+        for product in products:
+            queue_download(scene_label, downloads, product, products[product])
+    finally:
+        stop_download_workers(downloads, workers)
+        touch_index(index, scenes[scene_label]["target-dir"])
+    if len(result["failed"]) > 0:
+        write2log(scenes[scene_label]["log-file"],severity="WARNING",description="%s products downloaded, %s products were not downloaded." % (len(result["downloaded"]), len(result["failed"])))
+        write2log(parent_log_path,severity="ERROR",description="Error in downloading %s products. See log file at %s." % (len(result["failed"]), scenes[scene_label]["log-file"]))
+        return api, watermark, False
+    write2log(scenes[scene_label]["log-file"],severity="INFO",description="Download is complete.")
+    return api, watermark, True
+
+def stream_part(scene_label, part, area, query, index, downloads, found):
+    # pages of one part of the area into the download queue
+    api, _ = get_api(scene_label)
+    try:
+        offset = 0
+        while True:
+            # stable order, products added to the hub meanwhile are found on the next run
+            api, products = query_hub(scene_label, api, order_by = "+beginposition", limit = api.page_size, offset = offset, **dict(query, area=part))
+            offset += len(products)
+            for product in products:
+                with found["lock"]:
+                    if product in found["seen"]:
                         continue
-                    api_filename = os.path.splitext(filename)[0] if os.path.splitext(filename)[1] == ".zip" else filename
-                    products = api.query(
-                        filename = api_filename
-                    )
-                    if len(products) == 0:
-                        write2log(scenes[scene_label]["log-file"],severity="WARNING",description="Product %s in the target folder cannot be found via API. The file may be corrupt." % filename)
-                    else:
-                        file_date = api.get_product_odata(list(products)[0])["date"]
-                        file_not_valid = True
-                        for date_extent in date_extents:
-                            if file_date >= date_extent[0] and file_date <= date_extent[1]:
-                                file_not_valid = False
-                                break
-                        if file_not_valid:
-                            os.remove(os.path.join(scenes[scene_label]["target-dir"],filename))
-                            num_deleted += 1
-
-        write2log(parent_log_path,severity="INFO",description="Completed. Further information in the log file.")
\ No newline at end of file
+                    found["seen"].add(product)
+                    if outside_area(area, products[product]):
+                        found["outside"] += 1
+                        continue
+                    found["products"] += 1
+                    if "ingestiondate" in products[product] and (found["watermark"] is None or products[product]["ingestiondate"] > found["watermark"]):
+                        found["watermark"] = products[product]["ingestiondate"]
+                if is_indexed(index, product, products[product]):
+                    count_metric("sentsync_products_existing_total", scene=scene_label)
+                else:
+                    queue_download(scene_label, downloads, product, products[product])
+            if len(products) < api.page_size:
+                break
+    finally:
+        release_api(api)
+
+def stream_extent(scene_label, api, query, index):
+    # query page by page and download while querying, returns (api, watermark, complete)
+    # a full download queue blocks the paging (backpressure), so memory use does not depend on the range length
+    parts, area = query_area(scene_label)
+    downloads, workers, result = start_download_workers(scene_label, api, index)
+    found = {"lock": threading.Lock(), "seen": set(), "products": 0, "outside": 0, "watermark": None}
+    try:
+        refresh_index(index, scenes[scene_label]["target-dir"])
+        map_parts(lambda part: stream_part(scene_label, part, area, query, index, downloads, found), parts)
+    finally:
+        stop_download_workers(downloads, workers)
+        touch_index(index, scenes[scene_label]["target-dir"])
+
+    if found["outside"] > 0:
+        write2log(scenes[scene_label]["log-file"],severity="INFO",description="%s products found in the query area were outside the area of the scene." % found["outside"])
+    write2log(scenes[scene_label]["log-file"],severity="INFO",description="%s products found, %s new products downloaded, %s failed." % (found["products"], len(result["downloaded"]), len(result["failed"])),
+        scene=scene_label, extent=query["date"], products=found["products"], downloaded=len(result["downloaded"]), failed=len(result["failed"]))
+    return api, found["watermark"], len(result["failed"]) == 0
+
+def remove_out_of_range(scene_label, date_extents, index):
+    # rolling sync, one pass over the index after all date extents are downloaded
+    write2log(scenes[scene_label]["log-file"],severity="INFO",description="Removing products out of day-offset range (rolling sync)")
+    refresh_index(index, scenes[scene_label]["target-dir"])
+    num_deleted = 0
+    for filename, sensing_time in indexed_files(index):
+        if sensing_time is None:
+            # not downloaded by us, ask the hub once and keep the answer in the index
+            api_filename = os.path.splitext(filename)[0] if os.path.splitext(filename)[1] == ".zip" else filename
+            # with its own session reference, as query_hub may renew it
+            api, _ = get_api(scene_label)
+            try:
+                api, products = query_hub(scene_label, api,
+                    filename = api_filename + "*"
+                )
+            finally:
+                release_api(api)
+            if len(products) == 0:
+                write2log(scenes[scene_label]["log-file"],severity="WARNING",description="Product %s in the target folder cannot be found via API. The file may be corrupt." % filename)
+                continue
+            product = list(products)[0]
+            add_metadata_to_index(index, filename, product, products[product])
+            file_date = products[product]["beginposition"]
+        else:
+            file_date = datetime.datetime.fromisoformat(sensing_time)
+        file_not_valid = True
+        for date_extent in date_extents:
+            if file_date >= date_extent[0] and file_date <= date_extent[1]:
+                file_not_valid = False
+                break
+        if file_not_valid:
+            os.remove(os.path.join(scenes[scene_label]["target-dir"],filename))
+            remove_from_index(index, filename)
+            num_deleted += 1
+    touch_index(index, scenes[scene_label]["target-dir"])
+    count_metric("sentsync_cleanup_deleted_total", num_deleted, scene=scene_label)
+    write2log(scenes[scene_label]["log-file"],severity="INFO",description="%s products removed." % num_deleted)
+
+def run_scene_safely(scene_label, run_time):
+    # worker entry point, a failing scene must not take the others down
+    try:
+        return run_scene(scene_label, run_time)
+    except Exception as e:
+        write2log(parent_log_path,severity="ERROR",description="Unexpected error in the scene %s: %s" % (scene_label, repr(e)))
+
+schedule = []
+schedule_counter = itertools.count()
+# the valid schedule entry of each scene, entries replaced or of removed scenes are skipped
+scheduled = {}
+hub_backoff = {}
+running = {}
+# due scenes waiting for a free worker or hub
+waiting = []
+postponed = set()
+# config changes of running scenes, applied when they finish (None removes the scene)
+pending_updates = {}
+
+def jitter():
+    return datetime.timedelta(seconds=random.uniform(0,schedule_jitter))
+
+def scene_priority(scene_label):
+    return scenes[scene_label]["priority"]
+
+def has_free_slot(scene_label, group, limit):
+    # group are the scenes sharing the limit; one slot is kept for the scenes of the highest priority of the group,
+    # with a limit of 1 they may run beside a scene of lower priority
+    top_priority = min(scene_priority(label) for label in group)
+    group_running = [label for label in running.values() if label in group]
+    if scene_priority(scene_label) == top_priority:
+        return len([label for label in group_running if scene_priority(label) == top_priority]) < limit and len(group_running) < max(limit, 2)
+    return len(group_running) < limit and len([label for label in group_running if scene_priority(label) != top_priority]) < max(limit - 1, 1)
+
+def schedule_scene(scene_label, due_time):
+    seq = next(schedule_counter)
+    scheduled[scene_label] = seq
+    heapq.heappush(schedule, (due_time, scene_priority(scene_label), seq, scene_label))
+
+def is_scheduled(entry):
+    return scheduled.get(entry[3]) == entry[2]
+
+def next_due():
+    # the next valid schedule entry or None
+    while len(schedule) > 0 and not is_scheduled(schedule[0]):
+        heapq.heappop(schedule)
+    return schedule[0] if len(schedule) > 0 else None
+
+def scene_finished(scene_label, hub_ok):
+    hub_url = scenes[scene_label]["hub-url"]
+    now = datetime.datetime.utcnow()
+    # the errors of runs started before the hub was backed off were counted already
+    counted = hub_url in hub_backoff and scenes[scene_label]["last-run-time"] < hub_backoff[hub_url]["since"]
+    if hub_ok is False and not counted:
+        failures = hub_backoff[hub_url]["failures"] + 1 if hub_url in hub_backoff else 1
+        hub_backoff[hub_url] = {"failures": failures, "since": now, "until": now + min(hub_backoff_time * 2 ** (failures - 1), hub_backoff_max)}
+        set_metric("sentsync_hub_errors_in_row", failures, hub=hub_url)
+        write2log(parent_log_path,severity="WARNING",description="Hub %s gave errors %s times in a row. Not using it until %s." % (hub_url, failures, hub_backoff[hub_url]["until"].strftime("%Y%m%dT%H%M%S")))
+    elif hub_ok:
+        hub_backoff.pop(hub_url, None)
+        set_metric("sentsync_hub_errors_in_row", 0, hub=hub_url)
+    if scene_label in pending_updates:
+        update_scene(scene_label, pending_updates.pop(scene_label))
+        return
+    # Re-run/NRT, next run is due rerun-latency after the start of this one
+    if scenes[scene_label]["rerun-latency"] is not None:
+        due_time = max(scenes[scene_label]["last-run-time"] + datetime.timedelta(seconds=scenes[scene_label]["rerun-latency"]), now) + jitter()
+        schedule_scene(scene_label, due_time)
+        write2log(parent_log_path,severity="INFO",description="The scene %s is due again at %s." % (scene_label, due_time.strftime("%Y%m%dT%H%M%S")))
+
+def first_due_time(scene_label, now):
+    # scenes run at start, reruns not before rerun-latency after the last run, also of an earlier process
+    if scenes[scene_label]["rerun-latency"] is not None and scenes[scene_label]["last-run-time"] is not None:
+        return max(scenes[scene_label]["last-run-time"] + datetime.timedelta(seconds=scenes[scene_label]["rerun-latency"]), now) + jitter()
+    return now + jitter()
+
+runtime_keys = ["last-run-time","last-full-query","watermarks"]
+# if these change, the state of the scene (watermarks, last run) does not apply anymore
+query_keys = ["wkt","product","hub-url","username","day","day-offset","day-range"]
+
+def update_scene(scene_label, new_scene):
+    # replace a scene with its new config, None removes it; a running scene is updated when it finishes
+    if scene_label in running.values():
+        pending_updates[scene_label] = new_scene
+        write2log(parent_log_path,severity="INFO",description="The scene %s changed in the config file. It is updated when its run finishes." % scene_label)
+        return
+    scheduled.pop(scene_label, None)
+    postponed.discard(scene_label)
+    if new_scene is None:
+        del scenes[scene_label]
+        write2log(parent_log_path,severity="INFO",description="The scene %s was removed from the config file." % scene_label)
+        return
+    now = datetime.datetime.utcnow()
+    state_kept = scene_label in scenes and all(scenes[scene_label][arg] == new_scene[arg] for arg in query_keys)
+    if state_kept:
+        for arg in runtime_keys:
+            new_scene[arg] = scenes[scene_label][arg]
+        write2log(parent_log_path,severity="INFO",description="The scene %s changed in the config file. Its state is kept." % scene_label)
+    elif scene_label in scenes:
+        write2log(parent_log_path,severity="INFO",description="The scene %s changed in the config file. Its queries changed, it is run from start." % scene_label)
+    else:
+        write2log(parent_log_path,severity="INFO",description="The scene %s was added to the config file." % scene_label)
+    scenes[scene_label] = new_scene
+    if not state_kept:
+        load_scene_state(scene_label)
+    if new_scene["rerun-latency"] is not None:
+        set_metric("sentsync_rerun_latency_seconds", new_scene["rerun-latency"], scene=scene_label)
+    # a scene already run once by this process runs again only if it has rerun-latency
+    if not state_kept or new_scene["last-run-time"] is None or new_scene["rerun-latency"] is not None:
+        schedule_scene(scene_label, first_due_time(scene_label, now))
+
+def same_scene_config(scene, new_scene):
+    # None is a removed scene
+    if scene is None:
+        return False
+    return {arg: value for arg, value in scene.items() if arg not in runtime_keys} == {arg: value for arg, value in new_scene.items() if arg not in runtime_keys}
+
+def reload_config():
+    # a config that is not valid is rejected as a whole, the running scenes are kept
+    try:
+        cfg = load_config(args.config_file)
+        options = parse_daemon_options(cfg)
+        new_scenes = read_scenes(cfg, args.config_file)
+        for scene_label in new_scenes:
+            check_scene(scene_label, new_scenes[scene_label])
+    except ConfigError as e:
+        write2log(parent_log_path,severity="ERROR",description="The changed config file is not valid: %s%s Keeping the previous config." % (str(e), "" if e.scene_label is None else " Check scene %s." % e.scene_label))
+        return
+    if (options["metrics_port"], options["metrics_address"]) != (metrics_port, metrics_address):
+        write2log(parent_log_path,severity="WARNING",description="Changes of metrics-port and metrics-address need a restart.")
+        options["metrics_port"], options["metrics_address"] = metrics_port, metrics_address
+    apply_daemon_options(options)
+    # a running scene is compared with its update waiting for the end of the run, if any
+    for scene_label in list(scenes):
+        if scene_label not in new_scenes and pending_updates.get(scene_label, scenes[scene_label]) is not None:
+            update_scene(scene_label, None)
+    for scene_label in new_scenes:
+        if scene_label in scenes and same_scene_config(scenes[scene_label], new_scenes[scene_label]):
+            if scene_label in pending_updates:
+                # changed back to the config it is running with
+                del pending_updates[scene_label]
+                write2log(parent_log_path,severity="INFO",description="The scene %s changed back in the config file. It is kept when its run finishes." % scene_label)
+        elif scene_label not in scenes or not same_scene_config(pending_updates.get(scene_label, scenes[scene_label]), new_scenes[scene_label]):
+            update_scene(scene_label, new_scenes[scene_label])
+    write2log(parent_log_path,severity="INFO",description="Config file reloaded, %s scenes." % len(new_scenes))
+
+if args.rebuild_index:
+    for target_dir in set(scenes[scene_label]["target-dir"] for scene_label in scenes):
+        write2log(parent_log_path,severity="INFO",description="Rebuilding the product index of %s." % target_dir)
+        close_index(open_index(target_dir, rescan=True))
+
+if args.invalidate:
+    for name in args.invalidate:
+        if name != "all" and not any(name in (scene_label, scene_label.split("|")[0]) for scene_label in scenes):
+            write2log(parent_log_path,"ERROR","No scene %s to invalidate." % name)
+            terminate_cli()
+    for scene_label in scenes:
+        if "all" in args.invalidate or scene_label in args.invalidate or scene_label.split("|")[0] in args.invalidate:
+            write2log(parent_log_path,severity="INFO",description="Forgot %s completed date extents of the scene %s." % (invalidate_extents(scene_label), scene_label))
+
+for scene_label in scenes:
+    load_scene_state(scene_label)
+
+if args.plan:
+    print_plan(datetime.datetime.utcnow())
+    exit()
+
+for scene_label in scenes:
+    if scenes[scene_label]["rerun-latency"] is not None:
+        set_metric("sentsync_rerun_latency_seconds", scenes[scene_label]["rerun-latency"], scene=scene_label)
+if metrics_port is not None:
+    try:
+        start_metrics_server()
+        write2log(parent_log_path,severity="INFO",description="Serving metrics at http://%s:%s/metrics" % (metrics_address, metrics_port))
+    except Exception as e:
+        write2log(parent_log_path,severity="ERROR",description="Error in starting the metrics server: %s" % repr(e))
+
+write2log(parent_log_path,severity="INFO",description="Running scenes in %s parallel workers." % scene_workers)
+# one more thread than workers if a single worker is shared with the highest priority scenes
+executor = ThreadPoolExecutor(max_workers=max(scene_workers, 2))
+executor_workers = scene_workers
+announced = None
+
+start_time = datetime.datetime.utcnow()
+for scene_label in scenes:
+    schedule_scene(scene_label, first_due_time(scene_label, start_time))
+
+while len(scheduled) > 0 or len(running) > 0:
+    # config file changes are applied without a restart
+    if args.config_file is not None:
+        try:
+            mtime = os.stat(args.config_file).st_mtime_ns
+        except OSError:
+            mtime = config_mtime
+        if mtime != config_mtime:
+            config_mtime = mtime
+            write2log(parent_log_path,severity="INFO",description="Config file %s changed. Reloading." % args.config_file)
+            reload_config()
+            if scene_workers != executor_workers:
+                # the running scenes finish in the old workers
+                executor.shutdown(wait=False)
+                executor = ThreadPoolExecutor(max_workers=max(scene_workers, 2))
+                executor_workers = scene_workers
+
+    now = datetime.datetime.utcnow()
+    while next_due() is not None and next_due()[0] <= now:
+        waiting.append(heapq.heappop(schedule))
+    # NRT first, then the longest waiting
+    waiting.sort(key=lambda entry: (entry[1], entry[0]))
+
+    started = []
+    for entry in list(waiting):
+        due_time, priority, _, scene_label = entry
+        if not is_scheduled(entry):
+            waiting.remove(entry)
+            continue
+        hub_url = scenes[scene_label]["hub-url"]
+        if hub_url in hub_backoff and hub_backoff[hub_url]["until"] > now:
+            waiting.remove(entry)
+            schedule_scene(scene_label, hub_backoff[hub_url]["until"] + jitter())
+            write2log(parent_log_path,severity="INFO",description="Hub %s is backing off after errors. Postponing the scene %s." % (hub_url, scene_label))
+            continue
+        # all workers are busy, the scene waits for the next free one
+        if not has_free_slot(scene_label, scenes, scene_workers):
+            continue
+        # counted from the running scenes, so that a reloaded limit holds for the scenes already running
+        if not has_free_slot(scene_label, [label for label in scenes if scenes[label]["hub-url"] == hub_url], hub_limits.get(hub_url,hub_concurrency)):
+            if scene_label not in postponed:
+                postponed.add(scene_label)
+                write2log(parent_log_path,severity="INFO",description="Hub %s is busy with other scenes. Postponing the scene %s." % (hub_url, scene_label))
+            continue
+        waiting.remove(entry)
+        scheduled.pop(scene_label)
+        postponed.discard(scene_label)
+        scenes[scene_label]["last-run-time"] = now
+        write2log(parent_log_path,severity="INFO",description="Starting the scene %s %.1f seconds after its due time %s." % (scene_label, (now - due_time).total_seconds(), due_time.strftime("%Y%m%dT%H%M%S")),
+            scene=scene_label, due=due_time, late=(now - due_time).total_seconds())
+        observe_metric("sentsync_scene_start_delay_seconds", (now - due_time).total_seconds(), scene=scene_label)
+        running[executor.submit(run_scene_safely, scene_label, now)] = scene_label
+        started.append(scene_label)
+
+    if len(started) > 1:
+        plan = plan_queries(started, now)
+        write2log(parent_log_path,severity="INFO",description="%s scenes started, %s full queries planned for %s scene date extents." % (len(started), len(plan), sum(len(scene_labels) for scene_labels in plan.values())))
+
+    cleanup_sessions()
+    cleanup_shared_queries()
+    try:
+        prune_store()
+    except Exception as e:
+        write2log(parent_log_path,severity="ERROR",description="Error in pruning the product store %s: %s" % (product_store, repr(e)))
+    set_metric("sentsync_scenes_running", len(running))
+    set_metric("sentsync_scenes_waiting", len(waiting))
+    if metrics_file is not None:
+        try:
+            write_metrics_file()
+        except Exception as e:
+            write2log(parent_log_path,severity="ERROR",description="Error in writing the metrics file %s: %s" % (metrics_file, repr(e)))
+
+    # sleep until the next scene is due, but wake up if a scene finishes as it frees a worker and a hub
+    nap_time = housekeeping_time
+    if args.config_file is not None:
+        nap_time = min(nap_time, config_check_time)
+    if next_due() is not None:
+        nap_time = min(nap_time, max(next_due()[0] - datetime.datetime.utcnow(), datetime.timedelta(0)))
+    if len(running) > 0:
+        done, _ = wait(list(running), timeout=nap_time.total_seconds(), return_when=FIRST_COMPLETED)
+        for future in done:
+            scene_finished(running.pop(future), future.result())
+    elif next_due() is not None and nap_time.total_seconds() > 0:
+        # logged once per due scene, not on every config check
+        if next_due()[2] != announced:
+            announced = next_due()[2]
+            write2log(parent_log_path,severity="INFO",description="Next scene %s is due at %s. Sleeping %s seconds." % (next_due()[3], next_due()[0].strftime("%Y%m%dT%H%M%S"), (next_due()[0] - datetime.datetime.utcnow()).total_seconds()))
+        sleep(nap_time.total_seconds())
+
+executor.shutdown()
+if metrics_file is not None:
+    try:
+        write_metrics_file()
+    except Exception as e:
+        write2log(parent_log_path,severity="ERROR",description="Error in writing the metrics file %s: %s" % (metrics_file, repr(e)))
@@ -0,0 +1,166 @@
+#!/usr/bin/python3
+
+# End-to-end benchmark of sentsync against the local mock hub (tools/mock_hub.py).
+# Every scenario starts its own mock hub and runs sentsync.py in a scratch directory.
+# Reported per run: wall time, hub requests, peak memory of sentsync and download throughput.
+
+import argparse, sys, os
+import datetime, json, shutil, subprocess, tempfile, threading
+import requests
+
+
+toolsdir = os.path.dirname(os.path.realpath(sys.argv[0]))
+scenario_names = ["nrt", "backfill", "cleanup", "scenes"]
+
+parser = argparse.ArgumentParser(description = "Benchmark sentsync end to end against a local mock hub.")
+parser.add_argument('-s', '--scenario', action = 'append', choices = scenario_names, help = "Scenario to run, can be used multiple times (default all). nrt: a cold sync and a poll cycle of day-offset scenes. backfill: a 16 month day-range. cleanup: rolling sync over files not downloaded by sentsync. scenes: many scenes on one hub.")
+parser.add_argument('--sentsync', default = os.path.join(os.path.dirname(toolsdir), "sentsync.py"), help = "Path to sentsync.py (default the one of this repository).")
+parser.add_argument('--python', default = sys.executable, help = "Python used to run sentsync and the mock hub (default this one).")
+parser.add_argument('--product-size', type = int, default = 256*1024, help = "Size of the products in bytes (default 262144).")
+parser.add_argument('--bandwidth', type = float, default = 0, help = "Download speed per connection of the mock hub in MB/s, 0 for unlimited (default 0).")
+parser.add_argument('--latency', type = float, default = 0, help = "Seconds the mock hub waits before every response (default 0).")
+parser.add_argument('--nrt-products', type = int, default = 2000, help = "Products in the last 10 days for the nrt scenario (default 2000).")
+parser.add_argument('--backfill-products', type = int, default = 5000, help = "Products in 16 months for the backfill scenario (default 5000).")
+parser.add_argument('--cleanup-files', type = int, default = 50000, help = "Files in the target directory for the cleanup scenario (default 50000).")
+parser.add_argument('--scenes', type = int, default = 20, help = "Scenes in the scenes scenario (default 20).")
+parser.add_argument('--timeout', type = float, default = 3600, help = "Seconds after which a sentsync run is killed (default 3600).")
+parser.add_argument('--json', help = "Write the results to this json file, e.g. to compare runs.")
+parser.add_argument('--keep', action = "store_const", const = True, help = "Keep the scratch directories.")
+
+args = parser.parse_args()
+
+area = "POLYGON((4 57,32 57,32 72,4 72,4 57))"
+
+
+class MockHub:
+    def __init__(self, *hub_args):
+        command = [args.python, os.path.join(toolsdir, "mock_hub.py"), "--port", "0", "--product-size", str(args.product_size),
+            "--bandwidth", str(args.bandwidth), "--latency", str(args.latency)] + [str(arg) for arg in hub_args]
+        self.process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+        for line in self.process.stdout:
+            if line.startswith("Mock hub listening on "):
+                self.url = line.split()[-1]
+                break
+        else:
+            raise RuntimeError("Mock hub did not start")
+
+    def stats(self, reset=True):
+        return requests.get(self.url + "stats" + ("?reset=1" if reset else "")).json()
+
+    def titles(self):
+        # all products, read through the search api
+        titles = []
+        while True:
+            page = requests.get(self.url + "search", params={"format": "json", "rows": 10000, "start": len(titles), "q": "*"}).json()["feed"]["entry"]
+            titles += [entry["title"] for entry in page]
+            if len(page) < 10000:
+                return titles
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+
+
+def write_config(workdir, hub, scenes):
+    config_file = os.path.join(workdir, "config.json")
+    # no jitter and no query rate limit, the mock hub does not need protecting
+    config = {
+        "daemon": {"scene-workers": 4, "schedule-jitter": 0, "hub-query-rate": None},
+        "shared": {"hub-url": hub.url, "username": "bench", "password": "bench", "wkt": area},
+        "scenes": scenes,
+    }
+    with open(config_file, "w") as f:
+        json.dump(config, f, indent=1)
+    return config_file
+
+def scene(workdir, name, **options):
+    options["products"] = {"GRD": {"target-dir": os.path.join(workdir, name), "log-file": os.path.join(workdir, name, "log.log")}}
+    return options
+
+def run_sentsync(workdir, config_file, hub, label):
+    # one run, sentsync exits by itself as the scenes have no rerun-latency
+    hub.stats(reset=True)
+    script = os.path.join(workdir, "sentsync.py")
+    start = datetime.datetime.utcnow()
+    process = subprocess.Popen([args.python, script, "--config-file", config_file], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    timer = threading.Timer(args.timeout, process.kill)
+    timer.start()
+    stderr = process.stderr.read()
+    _, status, usage = os.wait4(process.pid, 0)
+    timer.cancel()
+    wall = (datetime.datetime.utcnow() - start).total_seconds()
+    stats = hub.stats(reset=True)
+    result = {
+        "run": label,
+        "wall_seconds": round(wall, 2),
+        "exit_code": os.waitstatus_to_exitcode(status),
+        "hub_requests": stats.get("requests", 0),
+        "search_requests": stats.get("search", 0),
+        "odata_requests": stats.get("odata", 0),
+        "downloads": stats.get("downloads", 0),
+        "downloaded_mb": round(stats.get("download_bytes", 0) / 1e6, 2),
+        "throughput_mb_per_second": round(stats.get("download_bytes", 0) / 1e6 / wall, 2) if wall > 0 else None,
+        # ru_maxrss is in kilobytes on linux
+        "peak_memory_mb": round(usage.ru_maxrss / 1024, 1),
+    }
+    if result["exit_code"] != 0:
+        print("sentsync exited with %s:\n%s" % (result["exit_code"], stderr[-2000:]))
+    return result
+
+def nrt(workdir):
+    hub = MockHub("--products", args.nrt_products, "--days", 10)
+    try:
+        config_file = write_config(workdir, hub, {"nrt": scene(workdir, "nrt", **{"day-offset": [0, -1, -2, -3]})})
+        return [run_sentsync(workdir, config_file, hub, "nrt cold sync"), run_sentsync(workdir, config_file, hub, "nrt poll cycle")]
+    finally:
+        hub.stop()
+
+def backfill(workdir):
+    hub = MockHub("--products", args.backfill_products, "--days", 487)
+    try:
+        today = datetime.datetime.utcnow()
+        day_range = (today - datetime.timedelta(days=487)).strftime("%Y%m%d") + "-" + today.strftime("%Y%m%d")
+        config_file = write_config(workdir, hub, {"backfill": scene(workdir, "backfill", **{"day-range": day_range})})
+        return [run_sentsync(workdir, config_file, hub, "backfill 16 months"), run_sentsync(workdir, config_file, hub, "backfill again")]
+    finally:
+        hub.stop()
+
+def cleanup(workdir):
+    # old products in the target directory, all of them are out of range
+    hub = MockHub("--products", args.cleanup_files, "--days", 730)
+    try:
+        target_dir = os.path.join(workdir, "cleanup")
+        os.makedirs(target_dir)
+        for title in hub.titles():
+            open(os.path.join(target_dir, title + ".zip"), "w").close()
+        config_file = write_config(workdir, hub, {"cleanup": scene(workdir, "cleanup", **{"day-offset": [0], "day-rolling": True})})
+        return [run_sentsync(workdir, config_file, hub, "rolling cleanup of %s files" % args.cleanup_files)]
+    finally:
+        hub.stop()
+
+def scenes(workdir):
+    hub = MockHub("--products", 1000, "--days", 5)
+    try:
+        config_file = write_config(workdir, hub, {"scene%02d" % i: scene(workdir, "scene%02d" % i, **{"day-offset": [0, -1, -2]}) for i in range(args.scenes)})
+        return [run_sentsync(workdir, config_file, hub, "%s scenes on one hub" % args.scenes)]
+    finally:
+        hub.stop()
+
+
+results = []
+for name in args.scenario or scenario_names:
+    workdir = tempfile.mkdtemp(prefix="sentsync-bench-%s-" % name)
+    shutil.copy(args.sentsync, os.path.join(workdir, "sentsync.py"))
+    print("Running %s in %s" % (name, workdir), flush=True)
+    try:
+        for result in globals()[name](workdir):
+            result["scenario"] = name
+            results.append(result)
+            print("- %(run)s: %(wall_seconds)s s, %(hub_requests)s hub requests (%(search_requests)s searches), %(downloads)s downloads, %(downloaded_mb)s MB, %(throughput_mb_per_second)s MB/s, peak memory %(peak_memory_mb)s MB" % result, flush=True)
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+if args.json:
+    with open(args.json, "w") as f:
+        json.dump({"time": datetime.datetime.utcnow().isoformat(), "args": vars(args), "results": results}, f, indent=1)
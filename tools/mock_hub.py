@@ -0,0 +1,386 @@
+#!/usr/bin/python3
+
+# Local stand-in for a Sentinel hub (DHuS), serving the OpenSearch and OData requests made by sentinelsat.
+# The catalogue is synthetic, the product payloads are generated on the fly.
+# Only the query syntax sentinelsat produces is understood, footprint intersection is tested on bounding boxes.
+
+import argparse
+import datetime, calendar
+import json, re, random, hashlib, bisect, fnmatch, base64
+import threading, time
+import http.server
+from urllib.parse import urlparse, parse_qs
+from uuid import UUID
+
+
+parser = argparse.ArgumentParser(description = "Mock Sentinel hub with a synthetic catalogue, for testing and benchmarking sentsync.")
+parser.add_argument('--host', default = "127.0.0.1", help = "Address to listen on (default 127.0.0.1).")
+parser.add_argument('--port', type = int, default = 8000, help = "Port to listen on, 0 for any free port (default 8000).")
+parser.add_argument('--products', type = int, default = 1000, help = "Number of products in the catalogue (default 1000).")
+parser.add_argument('--days', type = float, default = 10, help = "The products are spread over that many days before the start of the hub (default 10).")
+parser.add_argument('--live', type = int, default = 0, help = "Number of products ingested after the start of the hub (default 0).")
+parser.add_argument('--live-interval', type = float, default = 60, help = "Seconds between the ingestions of the live products (default 60).")
+parser.add_argument('--product-size', type = int, default = 1024*1024, help = "Size of the product payloads in bytes (default 1048576).")
+parser.add_argument('--bbox', default = "4,57,32,72", help = "Area of the footprints: west,south,east,north (default 4,57,32,72).")
+parser.add_argument('--footprint-size', type = float, default = 2.5, help = "Width and height of the footprints in degrees (default 2.5).")
+parser.add_argument('--product-type', default = "GRD", help = "Product type of the catalogue (default GRD).")
+parser.add_argument('--bandwidth', type = float, default = 0, help = "Download speed per connection in MB/s, 0 for unlimited (default 0).")
+parser.add_argument('--latency', type = float, default = 0, help = "Seconds added before every response (default 0).")
+parser.add_argument('--error-rate', type = float, default = 0, help = "Fraction of the searches answered with 503 Service Unavailable (default 0).")
+parser.add_argument('--offline-fraction', type = float, default = 0, help = "Fraction of the products in the long term archive (default 0).")
+parser.add_argument('--lta-delay', type = float, default = 60, help = "Seconds until an offline product is online after the retrieval is triggered (default 60).")
+parser.add_argument('--username', help = "Require this username (any credentials are accepted if not given).")
+parser.add_argument('--password', help = "Require this password.")
+parser.add_argument('--seed', type = int, default = 0, help = "Seed of the random catalogue (default 0).")
+
+args = parser.parse_args()
+
+start_time = datetime.datetime.utcnow().replace(microsecond=0)
+chunk_size = 64*1024
+
+stats = {}
+stats_lock = threading.Lock()
+
+def count(key, value=1):
+    with stats_lock:
+        stats[key] = stats.get(key, 0) + value
+
+def iso(dt):
+    return dt.strftime("%Y-%m-%dT%H:%M:%S.") + "%03dZ" % (dt.microsecond // 1000)
+
+def odata_time(dt):
+    return "/Date(%d)/" % (calendar.timegm(dt.utctimetuple()) * 1000 + dt.microsecond // 1000)
+
+def parse_time(value):
+    value = value.strip('"')
+    if value == "*":
+        return None
+    if value == "NOW":
+        return datetime.datetime.utcnow()
+    for time_format in ["%Y-%m-%dT%H:%M:%S.%fZ", "%Y-%m-%dT%H:%M:%SZ"]:
+        try:
+            return datetime.datetime.strptime(value, time_format)
+        except ValueError:
+            pass
+    raise ValueError("Unsupported date %s" % value)
+
+def wkt_bbox(wkt):
+    # (west, south, east, north) of all coordinates in the wkt
+    coords = [tuple(map(float, pair)) for pair in re.findall(r"(-?[\d.]+(?:[eE][-+]?\d+)?)\s+(-?[\d.]+(?:[eE][-+]?\d+)?)", wkt)]
+    return (min(c[0] for c in coords), min(c[1] for c in coords), max(c[0] for c in coords), max(c[1] for c in coords))
+
+def bbox_intersects(a, b):
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+def make_product(i, begin, ingestion, rng):
+    west, south, east, north = map(float, args.bbox.split(","))
+    x = rng.uniform(west, max(west, east - args.footprint_size))
+    y = rng.uniform(south, max(south, north - args.footprint_size))
+    bbox = (x, y, x + args.footprint_size, y + args.footprint_size)
+    end = begin + datetime.timedelta(seconds=25)
+    title = "S1A_IW_%sH_1SDV_%s_%s_%06d_%06X_%04X" % (args.product_type[:3], begin.strftime("%Y%m%dT%H%M%S"), end.strftime("%Y%m%dT%H%M%S"), 40000 + i // 15, i % 0xFFFFFF, i % 0xFFFF)
+    return {
+        "uuid": str(UUID(int=rng.getrandbits(128), version=4)),
+        "title": title,
+        "filename": title + ".SAFE",
+        "beginposition": begin,
+        "endposition": end,
+        "ingestiondate": ingestion,
+        "bbox": bbox,
+        "footprint": "POLYGON((%.4f %.4f,%.4f %.4f,%.4f %.4f,%.4f %.4f,%.4f %.4f))" % (bbox[0], bbox[1], bbox[2], bbox[1], bbox[2], bbox[3], bbox[0], bbox[3], bbox[0], bbox[1]),
+        "orbit": 40000 + i // 15,
+        "size": args.product_size,
+        "online": rng.random() >= args.offline_fraction,
+    }
+
+def make_catalogue():
+    rng = random.Random(args.seed)
+    products = []
+    span = datetime.timedelta(days=args.days)
+    for i in range(args.products):
+        begin = start_time - span + span * (i + 0.5) / args.products
+        # the hubs ingest the products some hours after sensing, nothing is ingested after the start though
+        ingestion = min(begin + datetime.timedelta(seconds=rng.uniform(3600, 3*3600)), start_time)
+        products.append(make_product(i, begin, ingestion, rng))
+    for i in range(args.live):
+        ingestion = start_time + datetime.timedelta(seconds=args.live_interval * (i + 1))
+        products.append(make_product(args.products + i, ingestion - datetime.timedelta(hours=1), ingestion, rng))
+    products.sort(key=lambda product: product["beginposition"])
+    return products
+
+print("Generating %s products" % (args.products + args.live))
+catalogue = make_catalogue()
+by_uuid = {product["uuid"]: product for product in catalogue}
+begin_keys = [product["beginposition"] for product in catalogue]
+by_filename = sorted((product["filename"], product["uuid"]) for product in catalogue)
+filename_keys = [item[0] for item in by_filename]
+checksums = {}
+checksums_lock = threading.Lock()
+lta_requests = {}
+
+def is_visible(product, now):
+    return product["ingestiondate"] <= now
+
+def is_online(product, now):
+    if product["online"]:
+        return True
+    return product["uuid"] in lta_requests and now - lta_requests[product["uuid"]] >= datetime.timedelta(seconds=args.lta_delay)
+
+def payload_block(product):
+    # deterministic content, so that the checksum can be computed again
+    return hashlib.sha256(product["uuid"].encode()).digest() * (chunk_size // 32)
+
+def payload_chunks(product, offset=0):
+    block = payload_block(product)
+    position = offset
+    while position < product["size"]:
+        start = position % chunk_size
+        length = min(chunk_size - start, product["size"] - position)
+        yield block[start:start + length]
+        position += length
+
+def checksum(product):
+    with checksums_lock:
+        if product["uuid"] in checksums:
+            return checksums[product["uuid"]]
+    md5 = hashlib.md5()
+    for chunk in payload_chunks(product):
+        md5.update(chunk)
+    with checksums_lock:
+        checksums[product["uuid"]] = md5.hexdigest().upper()
+        return checksums[product["uuid"]]
+
+def parse_query(q):
+    # returns (ranges, terms, bbox) of a sentinelsat query string
+    bbox = None
+    match = re.search(r'footprint:"Intersects\((.*)\)"', q)
+    if match:
+        bbox = wkt_bbox(match.group(1))
+        q = q[:match.start()] + q[match.end():]
+    ranges = {}
+    for field, low, high in re.findall(r'(\w+):\[(\S+) TO (\S+)\]', q):
+        ranges[field.lower()] = (parse_time(low), parse_time(high))
+    q = re.sub(r'(\w+):\[(\S+) TO (\S+)\]', '', q)
+    terms = {}
+    for field, value in re.findall(r'(\w+):("[^"]*"|\S+)', q):
+        terms[field.lower()] = value.strip('"')
+    return ranges, terms, bbox
+
+def search(q, order_by):
+    now = datetime.datetime.utcnow()
+    ranges, terms, bbox = parse_query(q)
+    candidates = catalogue
+    if "filename" in terms and "*" not in terms["filename"].rstrip("*") and "?" not in terms["filename"]:
+        # prefix search, used by sentsync for the files in the target directory
+        prefix = terms["filename"].rstrip("*")
+        first = bisect.bisect_left(filename_keys, prefix)
+        candidates = []
+        for filename, uuid in by_filename[first:]:
+            if not filename.startswith(prefix):
+                break
+            candidates.append(by_uuid[uuid])
+    elif "beginposition" in ranges:
+        low, high = ranges["beginposition"]
+        first = 0 if low is None else bisect.bisect_left(begin_keys, low)
+        last = len(catalogue) if high is None else bisect.bisect_right(begin_keys, high)
+        candidates = catalogue[first:last]
+    results = []
+    for product in candidates:
+        if not is_visible(product, now):
+            continue
+        if bbox is not None and not bbox_intersects(bbox, product["bbox"]):
+            continue
+        if not all(field not in product or ((low is None or product[field] >= low) and (high is None or product[field] <= high)) for field, (low, high) in ranges.items()):
+            continue
+        if "producttype" in terms and terms["producttype"] != args.product_type:
+            continue
+        if "filename" in terms and not fnmatch.fnmatchcase(product["filename"], terms["filename"]):
+            continue
+        results.append(product)
+    if order_by:
+        field, direction = (order_by.split(" ") + ["asc"])[:2]
+        if field in ["beginposition", "endposition", "ingestiondate"]:
+            results.sort(key=lambda product: product[field], reverse=direction == "desc")
+    return results
+
+def opensearch_entry(product, base_url):
+    odata_url = base_url + "odata/v1/Products('%s')/$value" % product["uuid"]
+    return {
+        "id": product["uuid"],
+        "title": product["title"],
+        "link": [{"href": odata_url}, {"rel": "alternative", "href": base_url + "odata/v1/Products('%s')/" % product["uuid"]}],
+        "summary": "Date: %s, Instrument: SAR-C SAR, Mode: VV VH, Satellite: Sentinel-1, Size: %.2f MB" % (iso(product["beginposition"]), product["size"] / 1024 / 1024),
+        "ondemand": "false" if product["online"] else "true",
+        "date": [
+            {"name": "ingestiondate", "content": iso(product["ingestiondate"])},
+            {"name": "beginposition", "content": iso(product["beginposition"])},
+            {"name": "endposition", "content": iso(product["endposition"])},
+        ],
+        "int": [{"name": "orbitnumber", "content": str(product["orbit"])}],
+        "str": [
+            {"name": "filename", "content": product["filename"]},
+            {"name": "footprint", "content": product["footprint"]},
+            {"name": "format", "content": "SAFE"},
+            {"name": "identifier", "content": product["title"]},
+            {"name": "platformname", "content": "Sentinel-1"},
+            {"name": "producttype", "content": args.product_type},
+            {"name": "size", "content": "%.2f MB" % (product["size"] / 1024 / 1024)},
+            {"name": "uuid", "content": product["uuid"]},
+        ],
+    }
+
+def odata_entry(product, base_url, now):
+    url = base_url + "odata/v1/Products('%s')" % product["uuid"]
+    west, south, east, north = product["bbox"]
+    # gml coordinates are lat,lon
+    coordinates = " ".join("%.4f,%.4f" % (lat, lon) for lon, lat in [(west, south), (east, south), (east, north), (west, north), (west, south)])
+    return {"d": {
+        "__metadata": {"id": url, "uri": url, "type": "DHuS.Product", "content_type": "application/octet-stream", "media_src": url + "/$value", "edit_media": url + "/$value"},
+        "Id": product["uuid"],
+        "Name": product["title"],
+        "ContentType": "application/octet-stream",
+        "ContentLength": str(product["size"]),
+        "ContentDate": {"__metadata": {"type": "DHuS.TimeRange"}, "Start": odata_time(product["beginposition"]), "End": odata_time(product["endposition"])},
+        "IngestionDate": odata_time(product["ingestiondate"]),
+        "CreationDate": odata_time(product["ingestiondate"]),
+        "EvictionDate": None,
+        "ContentGeometry": '<gml:Polygon srsName="http://www.opengis.net/gml/srs/epsg.xml#4326" xmlns:gml="http://www.opengis.net/gml"><gml:outerBoundaryIs><gml:LinearRing><gml:coordinates>%s</gml:coordinates></gml:LinearRing></gml:outerBoundaryIs></gml:Polygon>' % coordinates,
+        "Checksum": {"__metadata": {"type": "DHuS.Checksum"}, "Algorithm": "MD5", "Value": checksum(product)},
+        "Online": is_online(product, now),
+        "OnDemand": not product["online"],
+        "Attributes": {"__deferred": {"uri": url + "/Attributes"}},
+    }}
+
+
+class HubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately, do not wait for acks in between
+    disable_nagle_algorithm = True
+
+    def send_json(self, status, content):
+        body = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def send_error_json(self, status, message):
+        count("errors")
+        self.send_json(status, {"error": {"code": None, "message": {"lang": "en", "value": message}}})
+
+    def authorized(self):
+        if args.username is None:
+            return True
+        expected = "Basic " + base64.b64encode(("%s:%s" % (args.username, args.password or "")).encode()).decode()
+        return self.headers.get("Authorization") == expected
+
+    def base_url(self):
+        return "http://%s/" % self.headers.get("Host", "%s:%s" % self.server.server_address[:2])
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        path = url.path
+        if path == "/stats":
+            with stats_lock:
+                content = dict(stats)
+                if "reset" in params:
+                    stats.clear()
+            return self.send_json(200, content)
+
+        count("requests")
+        if args.latency > 0:
+            time.sleep(args.latency)
+        if not self.authorized():
+            count("unauthorized")
+            return self.send_error_json(401, "Unauthorized")
+
+        if path.endswith("/search"):
+            count("search")
+            if args.error_rate > 0 and random.random() < args.error_rate:
+                return self.send_error_json(503, "Service Unavailable")
+            try:
+                rows = int(params.get("rows", ["10"])[0])
+                start = int(params.get("start", ["0"])[0])
+                results = search(params.get("q", ["*"])[0], params.get("orderby", [None])[0])
+            except ValueError as e:
+                return self.send_json(200, {"feed": {"error": {"message": "org.apache.solr.search.SyntaxError: %s" % e}}})
+            page = results[start:start + rows]
+            count("search_products", len(page))
+            return self.send_json(200, {"feed": {
+                "opensearch:totalResults": str(len(results)),
+                "opensearch:startIndex": str(start),
+                "opensearch:itemsPerPage": str(rows),
+                "entry": [opensearch_entry(product, self.base_url()) for product in page],
+            }})
+
+        match = re.search(r"/odata/v1/Products\('([^']+)'\)(.*)$", path)
+        if match is None:
+            return self.send_error_json(404, "Not found")
+        product = by_uuid.get(match.group(1))
+        now = datetime.datetime.utcnow()
+        if product is None or not is_visible(product, now):
+            return self.send_error_json(404, "Invalid key (%s) to access Products" % match.group(1))
+        suffix = match.group(2).rstrip("/")
+
+        if suffix == "":
+            count("odata")
+            return self.send_json(200, odata_entry(product, self.base_url(), now))
+        if suffix == "/Online/$value":
+            count("online")
+            return self.send_json(200, is_online(product, now))
+        if suffix == "/$value":
+            if not is_online(product, now):
+                count("lta_triggered")
+                lta_requests.setdefault(product["uuid"], now)
+                self.send_response(202)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            return self.send_payload(product)
+        return self.send_error_json(404, "Not found")
+
+    def send_payload(self, product):
+        offset = 0
+        match = re.match(r"bytes=(\d+)-$", self.headers.get("Range", ""))
+        if match and int(match.group(1)) < product["size"]:
+            offset = int(match.group(1))
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %s-%s/%s" % (offset, product["size"] - 1, product["size"]))
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Disposition", 'inline; filename="%s.zip"' % product["title"])
+        self.send_header("Content-Length", str(product["size"] - offset))
+        self.end_headers()
+        if self.command == "HEAD":
+            return
+        count("downloads")
+        start = time.monotonic()
+        sent = 0
+        for chunk in payload_chunks(product, offset):
+            self.wfile.write(chunk)
+            sent += len(chunk)
+            if args.bandwidth > 0:
+                # keep the connection at the given speed
+                ahead = sent / (args.bandwidth * 1e6) - (time.monotonic() - start)
+                if ahead > 0:
+                    time.sleep(ahead)
+        count("download_bytes", sent)
+
+    def log_message(self, format, *args):
+        pass
+
+
+server = http.server.ThreadingHTTPServer((args.host, args.port), HubHandler)
+server.daemon_threads = True
+print("Mock hub listening on http://%s:%s/" % server.server_address[:2], flush=True)
+try:
+    server.serve_forever()
+except KeyboardInterrupt:
+    pass
@@ -3,13 +3,13 @@
 import numpy as np
 import argparse, sys
 
-from shapely.geometry import Polygon
-from shapely.ops import unary_union
 import shapely
 
 
 parser = argparse.ArgumentParser(description = "Create multipolygon from a list of tiles (tx,ty).")
 parser.add_argument('-t', '--tiles', action='append', help = "CSV file with tx and ty of Sentinel tiles. Can be used multiple times. First line is header: ty,tx.")
+parser.add_argument('-s', '--simplify', type = float, help = "Simplify the result within this tolerance in degrees (e.g. 0.01), so that it can be used as the wkt of a scene.")
+parser.add_argument('-o', '--output', help = "Write the WKT to this file instead of printing it.")
 
 args = parser.parse_args()
 
@@ -19,40 +19,70 @@ if not args.tiles:
 
 res=1/1008.0
 tsize=960
+# tiles of the grid from 80N to 20N and from 180W to 180E
+ny=round(60/res)//tsize
+nx=round(360/res)//tsize
 
 #tx=198
 #ty=36
 
-polygons = []
+tiles = []
 print("Reading tiles")
 for tilelist in args.tiles:
     try:
-        with open(tilelist,"r") as f:
-            f.readline()    # header
-            for line in f:
-                try:
-                    ty, tx = list(map(int,line.replace('\n','').split(',')))
-                except:
-                    print(tx,ty," failed")
-
-                lat=np.arange(80-res/2.0,20,-res,dtype=float)
-                lon=np.arange(-180+res/2.0,180,res,dtype=float)
-
-                tlat=lat[(ty-1)*tsize:ty*tsize]
-                tlon=lon[(tx-1)*tsize:tx*tsize]
-
-                poly = Polygon([(tlon[0],tlat[0]), (tlon[-1],tlat[0]), (tlon[-1],tlat[-1]), (tlon[0],tlat[-1]), (tlon[0],tlat[0]) ])
-                poly = Polygon([(tlon[0]-res,tlat[0]+res), (tlon[-1]+res,tlat[0]+res), (tlon[-1]+res,tlat[-1]-res), (tlon[0]-res,tlat[-1]-res), (tlon[0]-res,tlat[0]+res) ])
-                print(poly)
-                polygons.append(poly)
-                
-
+        # all lines at once, lines that are not two numbers come out as nan
+        rows = np.genfromtxt(tilelist, delimiter=",", skip_header=1, dtype=float, ndmin=2, invalid_raise=False)
+        if rows.size == 0:
+            continue
+        rows = rows[:,:2]
+        valid = np.all(np.isfinite(rows), axis=1) & np.all(rows == np.round(rows), axis=1)
+        valid[valid] &= (rows[valid,0] >= 1) & (rows[valid,0] <= ny) & (rows[valid,1] >= 1) & (rows[valid,1] <= nx)
+        for ty, tx in rows[~valid]:
+            print("%g %g  failed" % (tx,ty))
+        tiles.append(rows[valid].astype(int))
     except Exception as e:
         print("Cannot process %s" % tilelist)
         print(e)
         print("Skipped")
 
+if len(tiles) == 0:
+    print("No tiles read")
+    sys.exit()
+
+# unique tiles sorted by row (ty) then column (tx)
+tiles = np.unique(np.concatenate(tiles), axis=0)
+ty, tx = tiles[:,0], tiles[:,1]
+print("%s tiles" % len(tiles))
+
 print("Merging")
-polygons = shapely.unary_union(polygons).wkt
+# runs of adjacent tiles in a row become one box
+starts = np.flatnonzero(np.r_[True, (np.diff(ty) != 0) | (np.diff(tx) != 1)])
+ends = np.r_[starts[1:], len(tiles)] - 1
+run_ty, run_tx0, run_tx1 = ty[starts], tx[starts], tx[ends]
+# runs with the same columns in adjacent rows become one box
+order = np.lexsort((run_ty, run_tx1, run_tx0))
+run_ty, run_tx0, run_tx1 = run_ty[order], run_tx0[order], run_tx1[order]
+starts = np.flatnonzero(np.r_[True, (np.diff(run_tx0) != 0) | (np.diff(run_tx1) != 0) | (np.diff(run_ty) != 1)])
+ends = np.r_[starts[1:], len(run_ty)] - 1
+ty0, ty1, tx0, tx1 = run_ty[starts], run_ty[ends], run_tx0[starts], run_tx1[starts]
+
+# tile bounds from the pixel centres of the grid, widened by half a pixel (as the pixel edges) plus half a pixel,
+# so that adjacent boxes overlap and are merged
+north = 80 + res/2.0 - (ty0-1)*tsize*res
+south = 80 - res/2.0 - ty1*tsize*res
+west = -180 - res/2.0 + (tx0-1)*tsize*res
+east = -180 + res/2.0 + tx1*tsize*res
+boxes = shapely.box(west, south, east, north)
+print("%s boxes" % len(boxes))
+
+polygons = shapely.union_all(boxes)
+if args.simplify is not None:
+    polygons = polygons.simplify(args.simplify, preserve_topology=True)
+polygons = polygons.wkt
 
-print(polygons)
+if args.output is not None:
+    with open(args.output,"w") as f:
+        f.write(polygons + "\n")
+    print("Written to %s" % args.output)
+else:
+    print(polygons)